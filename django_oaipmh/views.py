@@ -14,13 +14,113 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+import calendar
+from datetime import datetime, timedelta
+import hashlib
+from itertools import islice
+import re
+import zlib
+
 from django.conf import settings
+from django.core import signing
+from django.http import HttpResponseNotModified, StreamingHttpResponse
+from django.utils.http import http_date, parse_http_date_safe
+from django.utils.timezone import utc
 from django.views.generic import TemplateView
 
 
+def utc_datetime(value):
+    # OAI datestamps are UTC; convert a datetime with a timezone to a naive
+    # UTC datetime, for comparison with from and until.  Naive datetimes
+    # are assumed to be UTC already.
+    if value is not None and value.tzinfo is not None:
+        value = value.astimezone(utc).replace(tzinfo=None)
+    return value
+
+
+def parse_datestamp(value, until=False):
+    # parse an OAI from or until argument, in either day or seconds
+    # granularity, as a naive UTC datetime; an until date includes the
+    # whole day.  Raises ValueError if the value is not a valid datestamp.
+    if value is None:
+        return None
+    if len(value) == len('YYYY-MM-DD'):
+        date = datetime.strptime(value, '%Y-%m-%d')
+        if until:
+            date += timedelta(days=1, microseconds=-1)
+        return date
+    return datetime.strptime(value, '%Y-%m-%dT%H:%M:%SZ')
+
+
+_accept_encoding_re = re.compile(r'\s*([^\s;,]+)\s*(?:;\s*q\s*=\s*([0-9.]+))?')
+
+
+def accepted_encoding(request, encodings):
+    # choose one of the given content-encodings, in order of preference,
+    # based on the request Accept-Encoding header; returns None if none
+    # of them is acceptable
+    header = request.META.get('HTTP_ACCEPT_ENCODING', '')
+    quality = {}
+    for item in header.split(','):
+        match = _accept_encoding_re.match(item)
+        if match:
+            try:
+                quality[match.group(1).lower()] = float(match.group(2) or 1)
+            except ValueError:
+                continue
+    best = None
+    for encoding in encodings:
+        q = quality.get(encoding, quality.get('*', 0))
+        if q > 0 and (best is None or q > quality.get(best, quality.get('*', 0))):
+            best = encoding
+    return best
+
+
+def compress_content(content, encoding, level=6, chunk_size=64 * 1024):
+    # compress a byte string with gzip or (zlib-wrapped) deflate, as used
+    # for HTTP content-encoding, yielding compressed data a chunk at a time
+    wbits = 16 + zlib.MAX_WBITS if encoding == 'gzip' else zlib.MAX_WBITS
+    compressor = zlib.compressobj(level, zlib.DEFLATED, wbits)
+    for start in range(0, len(content), chunk_size):
+        data = compressor.compress(content[start:start + chunk_size])
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def in_set(set_spec, sets):
+    # an item in a set is also in every set above it in the hierarchy,
+    # e.g. an item in a:b:c is in a:b and a
+    return any(s == set_spec or s.startswith(set_spec + ':') for s in sets)
+
+
 class OAIProvider(TemplateView):
     content_type = 'text/xml'  # possibly application/xml ?
 
+    # number of items in each ListIdentifiers response; the rest of the
+    # list is available with a resumption token.  Defaults to the
+    # OAI_BATCH_SIZE setting, or 100.
+    batch_size = None
+
+    # metadata formats available, by metadataPrefix
+    metadata_formats = {
+        'oai_dc': {
+            'schema': 'http://www.openarchives.org/OAI/2.0/oai_dc.xsd',
+            'namespace': 'http://www.openarchives.org/OAI/2.0/oai_dc/',
+        },
+    }
+
+    # request arguments kept in resumption tokens
+    list_arguments = ('metadataPrefix', 'from', 'until', 'set')
+
+    # content-encodings responses can be compressed with, in order of
+    # preference, when the harvester accepts them; advertised in Identify.
+    # Set to an empty tuple to disable compression.
+    compression = ('gzip', 'deflate')
+    compression_level = 6
+    # content-encoding negotiated for the current request
+    content_encoding = None
+
     # modeling on sitemaps: these methods should be implemented
     # when extending OAIProvider
 
@@ -32,9 +132,22 @@ class OAIProvider(TemplateView):
         pass
 
     def last_modified(self, obj):
-        # datetime object was last modified
+        # datetime object was last modified; either naive UTC or with a
+        # timezone
         pass
 
+    def filtered_items(self, from_date=None, until_date=None, set_spec=None):
+        # items last modified within a date range (inclusive; either end
+        # may be None) and in a set (including its subsets), for selective
+        # harvesting.  This default checks every item, so extending classes
+        # should use an index instead.
+        if from_date is None and until_date is None and set_spec is None:
+            return self.items()
+        return [i for i in self.items()
+                if (from_date is None or utc_datetime(self.last_modified(i)) >= from_date)
+                and (until_date is None or utc_datetime(self.last_modified(i)) <= until_date)
+                and (set_spec is None or in_set(set_spec, self.sets(i)))]
+
     def oai_identifier(self, obj):
         # oai identifier for a given object
         pass
@@ -43,7 +156,151 @@ class OAIProvider(TemplateView):
         # list of set identifiers for a given object
         return []
 
-    # TODO: get metadata record for a given object in a given metadata format
+    def set_list(self):
+        # list of (setSpec, setName) for all sets in the repository, in
+        # order; if empty, set requests return noSetHierarchy
+        return []
+
+    def version(self):
+        # identifier for the current state of the repository, e.g. a
+        # version or generation number that changes when items are added
+        # or removed; resumption tokens issued for another version are
+        # rejected, since their cursor may no longer be valid
+        return None
+
+    def get_batch_size(self):
+        return self.batch_size or getattr(settings, 'OAI_BATCH_SIZE', 100)
+
+    # resumption tokens are stateless: the cursor, the original request
+    # arguments and the repository version, signed so they cannot be
+    # altered by the harvester
+
+    def resumption_token(self, cursor, arguments):
+        return signing.dumps({'cursor': cursor, 'args': arguments,
+                              'version': self.version()},
+                             salt='django_oaipmh.resumption', compress=True)
+
+    def parse_resumption_token(self, token):
+        # returns the cursor and request arguments, or None if the token
+        # is not valid for the current version of the repository
+        try:
+            data = signing.loads(token, salt='django_oaipmh.resumption')
+        except signing.BadSignature:
+            return None
+        if data.get('version') != self.version():
+            return None
+        return data['cursor'], data['args']
+
+    def list_request(self):
+        # determine cursor and arguments for a list request, from the request
+        # or the resumption token; returns an error response if they are
+        # not valid, otherwise None
+        self.cursor = 0
+        token = self.request.GET.get('resumptionToken', None)
+        if token is not None:
+            # resumptionToken is an exclusive argument
+            if len([a for a in self.request.GET if a != 'verb']) > 1:
+                return self.error('badArgument',
+                                  'resumptionToken cannot be combined with other arguments')
+            parsed = self.parse_resumption_token(token)
+            if parsed is None:
+                return self.error('badResumptionToken',
+                                  'The resumptionToken is invalid or has expired')
+            self.cursor, self.oai_args = parsed
+            if 'metadataPrefix' not in self.oai_args:
+                # e.g. a ListSets token
+                return self.error('badResumptionToken',
+                                  'The resumptionToken is not valid for %s' % self.oai_verb)
+        else:
+            self.oai_args = dict((arg, self.request.GET[arg]) for arg in self.list_arguments
+                                 if arg in self.request.GET)
+            prefix = self.oai_args.get('metadataPrefix', None)
+            if prefix is None:
+                return self.error('badArgument', 'metadataPrefix is required')
+            if prefix not in self.metadata_formats:
+                return self.error('cannotDisseminateFormat',
+                                  'The metadata format "%s" is not supported' % prefix)
+
+        try:
+            self.from_date = parse_datestamp(self.oai_args.get('from', None))
+            self.until_date = parse_datestamp(self.oai_args.get('until', None), until=True)
+        except ValueError:
+            return self.error('badArgument', 'from and until must be dates in ' +
+                              'YYYY-MM-DD or YYYY-MM-DDThh:mm:ssZ format')
+        if 'from' in self.oai_args and 'until' in self.oai_args and \
+                len(self.oai_args['from']) != len(self.oai_args['until']):
+            return self.error('badArgument', 'from and until must have the same granularity')
+        if self.from_date and self.until_date and self.from_date > self.until_date:
+            return self.error('badArgument', 'from must not be later than until')
+        self.set_spec = self.oai_args.get('set', None)
+        if self.set_spec is not None and not self.set_list():
+            return self.error('noSetHierarchy', 'This repository does not support sets')
+
+    def list_batch(self):
+        # items for the current batch, and the resumption token for the
+        # next; the token is an empty string on the last batch of a
+        # resumed list, and None for a complete list
+        batch_size = self.get_batch_size()
+        # one extra item tells us whether there are more after this batch
+        items = self.filtered_items(self.from_date, self.until_date, self.set_spec)
+        if hasattr(items, '__getitem__'):
+            # lists and querysets; a queryset retrieves only the slice
+            batch = list(items[self.cursor:self.cursor + batch_size + 1])
+        else:
+            # items() may be a generator
+            batch = list(islice(items, self.cursor, self.cursor + batch_size + 1))
+        token = None
+        if len(batch) > batch_size:
+            batch = batch[:batch_size]
+            token = self.resumption_token(self.cursor + batch_size, self.oai_args)
+        elif self.cursor:
+            token = ''
+        return batch, token
+
+    def item_by_id(self, identifier):
+        # item for an oai identifier, or None if there is no such item;
+        # this default scans items(), so extending classes should look
+        # the item up directly
+        for i in self.items():
+            if self.oai_identifier(i) == identifier:
+                return i
+
+    def list_sets(self):
+        self.template_name = 'django_oaipmh/list_sets.xml'
+        self.cursor = 0
+        token = self.request.GET.get('resumptionToken', None)
+        if token is not None:
+            if len([a for a in self.request.GET if a != 'verb']) > 1:
+                return self.error('badArgument',
+                                  'resumptionToken cannot be combined with other arguments')
+            parsed = self.parse_resumption_token(token)
+            if parsed is None:
+                return self.error('badResumptionToken',
+                                  'The resumptionToken is invalid or has expired')
+            self.cursor = parsed[0]
+        sets = self.set_list()
+        if not sets:
+            return self.error('noSetHierarchy', 'This repository does not support sets')
+        batch_size = self.get_batch_size()
+        batch = sets[self.cursor:self.cursor + batch_size]
+        resumption_token = None
+        if self.cursor + batch_size < len(sets):
+            resumption_token = self.resumption_token(self.cursor + batch_size, {})
+        elif self.cursor:
+            resumption_token = ''
+        return self.render_to_response({
+            'sets': [{'spec': spec, 'name': name} for spec, name in batch],
+            'resumption_token': resumption_token, 'cursor': self.cursor})
+
+    def metadata(self, obj, prefix):
+        # serialized xml metadata record for a given object in a given
+        # metadata format (one of metadata_formats)
+        pass
+
+    def metadata_records(self, items, prefix):
+        # serialized metadata records for a batch of items, in order;
+        # override to retrieve or build records for the batch at once
+        return [self.metadata(i, prefix) for i in items]
 
     def render_to_response(self, context, **response_kwargs):
         # all OAI responses should be xml
@@ -55,8 +312,22 @@ class OAIProvider(TemplateView):
             'verb': self.oai_verb,
             'url': self.request.build_absolute_uri(self.request.path),
         })
-        return super(TemplateView, self) \
+        response = super(TemplateView, self) \
             .render_to_response(context, **response_kwargs)
+        if self.compression:
+            response['Vary'] = 'Accept-Encoding'
+        if self.content_encoding is None:
+            return response
+
+        # render now, and stream the xml compressed in chunks
+        response.render()
+        compressed = StreamingHttpResponse(
+            compress_content(response.content, self.content_encoding, self.compression_level),
+            status=response.status_code)
+        for header, value in response.items():
+            compressed[header] = value
+        compressed['Content-Encoding'] = self.content_encoding
+        return compressed
 
     def identify(self):
         self.template_name = 'django_oaipmh/identify.xml'
@@ -72,7 +343,7 @@ class OAIProvider(TemplateView):
             # class-level variable/configuration (may affect templates also)
             'granularity': 'YYYY-MM-DDThh:mm:ssZ',  # or YYYY-MM-DD
             # class-level config?
-            'compression': 'deflate',  # gzip?  - optional
+            'compression': self.compression,
             # description - optional
             # (place-holder values from OAI docs example)
             'identifier_scheme': 'oai',
@@ -84,17 +355,87 @@ class OAIProvider(TemplateView):
 
     def list_identifiers(self):
         self.template_name = 'django_oaipmh/list_identifiers.xml'
+        error = self.list_request()
+        if error is not None:
+            return error
+        batch, token = self.list_batch()
+        if not batch and not self.cursor:
+            return self.error('noRecordsMatch', 'No items match the request')
+        items = [self.item_info(i) for i in batch]
+        return self.render_to_response({'items': items, 'resumption_token': token,
+                                        'cursor': self.cursor})
+
+    def list_records(self):
+        self.template_name = 'django_oaipmh/list_records.xml'
+        error = self.list_request()
+        if error is not None:
+            return error
+        batch, token = self.list_batch()
+        if not batch and not self.cursor:
+            return self.error('noRecordsMatch', 'No items match the request')
         items = []
-        # TODO: eventually we will need pagination with oai resumption tokens
-        # should be able to model similar to django.contrib.sitemap
-        for i in self.items():
-            item_info = {
-                'identifier': self.oai_identifier(i),
-                'last_modified': self.last_modified(i),
-                'sets': self.sets(i)
-            }
+        records = self.metadata_records(batch, self.oai_args['metadataPrefix'])
+        for i, record in zip(batch, records):
+            item_info = self.item_info(i)
+            item_info['metadata'] = record
             items.append(item_info)
-        return self.render_to_response({'items': items})
+        return self.render_to_response({'items': items, 'resumption_token': token,
+                                        'cursor': self.cursor})
+
+    def get_record(self):
+        self.template_name = 'django_oaipmh/get_record.xml'
+        identifier = self.request.GET.get('identifier', None)
+        prefix = self.request.GET.get('metadataPrefix', None)
+        if identifier is None or prefix is None:
+            return self.error('badArgument', 'identifier and metadataPrefix are required')
+        if prefix not in self.metadata_formats:
+            return self.error('cannotDisseminateFormat',
+                              'The metadata format "%s" is not supported' % prefix)
+        obj = self.item_by_id(identifier)
+        if obj is None:
+            return self.error('idDoesNotExist', 'No item matches the identifier "%s"' % identifier)
+
+        # harvesters re-checking a record that has not changed get a 304
+        last_modified = utc_datetime(self.last_modified(obj))
+        # each content-encoding is a different representation, with its own etag
+        etag = '"%s"' % hashlib.md5(('%s %s %s %s %s' % (identifier, prefix, last_modified,
+                                                         self.version(), self.content_encoding)
+                                     ).encode('utf-8')).hexdigest()
+        timestamp = calendar.timegm(last_modified.utctimetuple()) if last_modified else None
+        if self.not_modified(etag, timestamp):
+            response = HttpResponseNotModified()
+        else:
+            item_info = self.item_info(obj)
+            item_info['metadata'] = self.metadata_records([obj], prefix)[0]
+            response = self.render_to_response({'item': item_info})
+        response['ETag'] = etag
+        if self.compression:
+            response['Vary'] = 'Accept-Encoding'
+        if timestamp is not None:
+            response['Last-Modified'] = http_date(timestamp)
+        return response
+
+    def not_modified(self, etag, timestamp):
+        # check conditional request headers against the current etag and
+        # last modification time of a record
+        if_none_match = self.request.META.get('HTTP_IF_NONE_MATCH', None)
+        if if_none_match is not None:
+            etags = [e.strip() for e in if_none_match.split(',')]
+            return etag in etags or '*' in etags
+        if_modified_since = parse_http_date_safe(
+            self.request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+        return bool(if_modified_since and timestamp is not None and
+                    timestamp <= if_modified_since)
+
+    def item_info(self, obj):
+        # header information for an item
+        last_modified = utc_datetime(self.last_modified(obj))
+        return {
+            'identifier': self.oai_identifier(obj),
+            'last_modified': last_modified,
+            'datestamp': last_modified.strftime('%Y-%m-%dT%H:%M:%SZ') if last_modified else '',
+            'sets': self.sets(obj)
+        }
 
     def error(self, code, text):
         # TODO: HTTP error response code? maybe 400 bad request?
@@ -109,6 +450,7 @@ class OAIProvider(TemplateView):
     # method
     def get(self, request, *args, **kwargs):
         self.request = request   # store for access in other functions
+        self.content_encoding = accepted_encoding(request, self.compression)
 
         self.oai_verb = request.GET.get('verb', None)
 
@@ -118,15 +460,18 @@ class OAIProvider(TemplateView):
         if self.oai_verb == 'ListIdentifiers':
             return self.list_identifiers()
 
+        if self.oai_verb == 'ListRecords':
+            return self.list_records()
+
+        if self.oai_verb == 'GetRecord':
+            return self.get_record()
+
+        if self.oai_verb == 'ListSets':
+            return self.list_sets()
+
         # OAI verbs still TODO:
         #
-        # GetRecord
-        #  - will probably require an item_by_id method similar items
         # ListMetadataFormats
-        # ListRecords
-        #  - should have some overlap/reusability with ListIdentifiers
-        # ListSets
-        #  - could start with noSetHierarchy in initial implementation
 
         else:
             # if no verb = bad request response
@@ -134,5 +479,5 @@ class OAIProvider(TemplateView):
             if self.oai_verb is None:
                 error_msg = 'The request did not provide any verb.'
             else:
-                'The verb "%s" is illegal' % self.oai_verb
+                error_msg = 'The verb "%s" is illegal' % self.oai_verb
             return self.error('badVerb', error_msg)
@@ -0,0 +1,123 @@
+import hashlib
+import logging
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from oxex.stylesheets import stylesheets
+
+logger = logging.getLogger(__name__)
+
+GENERATION_KEY = 'oxex:collection-generation'
+
+# cache backends that are not shared between processes; a generation
+# started by an ingest in another process is never seen by the web workers
+PROCESS_LOCAL_CACHES = ('django.core.cache.backends.locmem.LocMemCache',
+                        'django.core.cache.backends.dummy.DummyCache')
+
+
+# highest generation seen or handed out by this process
+_last_generation = [0]
+
+
+def _seen(generation):
+    if generation > _last_generation[0]:
+        _last_generation[0] = generation
+    return generation
+
+
+def _new_generation():
+    # generations are seeded from the clock (in milliseconds), and are
+    # always above the last generation this process has seen, so a counter
+    # that has been evicted starts again above the generations used before,
+    # and content cached for an old generation does not become live again
+    return max(int(time.time() * 1000), _last_generation[0] + 1)
+
+
+def collection_generation():
+    '''Current generation number of the document collection.  Cached
+    content derived from the collection, and the in-process document
+    indexes, are keyed on this number, so bumping it (see
+    :meth:`invalidate_collection`) retires all of it.
+
+    The generation is kept in the default Django cache, which must be
+    shared by the web workers and the ingest process (e.g. memcached);
+    see :meth:`check_shared_cache`.'''
+    generation = cache.get(GENERATION_KEY)
+    if generation is None:
+        cache.add(GENERATION_KEY, _new_generation(), None)
+        generation = cache.get(GENERATION_KEY) or _new_generation()
+    return _seen(generation)
+
+
+def invalidate_collection():
+    '''Invalidation hook for ingest: start a new collection generation so
+    that content cached for the previous one is no longer used.  Returns
+    the new generation number.'''
+    try:
+        return _seen(cache.incr(GENERATION_KEY))
+    except ValueError:
+        # generation not set or evicted; start over from the clock
+        generation = _new_generation()
+        cache.set(GENERATION_KEY, generation, None)
+        return _seen(generation)
+
+
+def check_shared_cache():
+    '''Warn if the default cache backend is local to the process, in which
+    case a new collection generation started by an ingest never reaches
+    the web workers.  Returns True if the cache is shared.'''
+    backend = settings.CACHES.get('default', {}).get('BACKEND', '')
+    if backend in PROCESS_LOCAL_CACHES:
+        logger.warning('The default cache backend (%s) is not shared between processes; ' +
+                       'collection changes made by load_tei will not reach the web workers ' +
+                       'until they are restarted.  Configure a shared cache such as memcached.',
+                       backend)
+        return False
+    return True
+
+
+# Lucene boolean operators, which are only operators in upper case
+QUERY_OPERATORS = ('AND', 'OR', 'NOT')
+
+
+def normalize_keyword(keyword):
+    '''Normalize search or highlight terms so equivalent searches share a
+    cache entry: whitespace is collapsed and terms are case-folded, but
+    upper-case boolean operators are kept, since ``foo AND bar`` and
+    ``foo and bar`` are different queries.'''
+    if not keyword:
+        return ''
+    return ' '.join(word if word in QUERY_OPERATORS else word.lower()
+                    for word in keyword.split())
+
+
+class RenderedDocumentCache(object):
+    '''Cache of rendered document display content (the ``form.xsl`` HTML
+    and the Dublin Core meta tags), keyed on document id, normalized
+    highlight keyword, collection generation and the version of the
+    ``form`` stylesheet, so an edited stylesheet is used straight away.
+    Cache hits are served without an eXist query or XSLT transform.'''
+
+    prefix = 'oxex:doc-display'
+
+    @property
+    def timeout(self):
+        return getattr(settings, 'OXEX_DOCUMENT_CACHE_TIMEOUT', 60 * 60 * 24)
+
+    def key(self, doc_id, keyword=None):
+        # hash the variable parts; ids and search terms are not
+        # guaranteed to be safe for every cache backend
+        digest = hashlib.md5((u'%s\n%s\n%r' % (doc_id, normalize_keyword(keyword),
+                                               stylesheets.version('form'))).encode('utf-8')).hexdigest()
+        return '%s:%s:%s' % (self.prefix, collection_generation(), digest)
+
+    def get(self, doc_id, keyword=None):
+        return cache.get(self.key(doc_id, keyword))
+
+    def set(self, doc_id, keyword, rendered):
+        cache.set(self.key(doc_id, keyword), rendered, self.timeout)
+
+
+rendered_documents = RenderedDocumentCache()
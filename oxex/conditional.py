@@ -0,0 +1,52 @@
+import hashlib
+
+from django.core.cache import cache
+from django.views.decorators.http import condition
+
+from eulexistdb.exceptions import DoesNotExist
+
+from oxex.cache import collection_generation, rendered_documents
+from oxex.models import DocTitle
+
+
+def document_validators(request, doc_id):
+    '''Last-modified time and SHA-1 content hash for a stored document,
+    as a tuple; ``(None, None)`` if the document does not exist.
+
+    Validators come from a metadata-only eXist query (no document content
+    is returned) and are cached per collection generation, and on the
+    request so the ETag and Last-Modified checks share one lookup.'''
+    validators = getattr(request, '_oxex_validators', {})
+    if doc_id not in validators:
+        key = 'oxex:doc-validators:%s:%s' % (collection_generation(),
+            hashlib.md5(doc_id.encode('utf-8')).hexdigest())
+        validators[doc_id] = cache.get(key)
+        if validators[doc_id] is None:
+            try:
+                meta = DocTitle.objects.only('last_modified', 'hash').get(id=doc_id)
+                validators[doc_id] = (meta.last_modified, meta.hash)
+                cache.set(key, validators[doc_id], rendered_documents.timeout)
+            except DoesNotExist:
+                validators[doc_id] = (None, None)
+        request._oxex_validators = validators
+    return validators[doc_id]
+
+
+def document_condition(variant):
+    '''View decorator for conditional GET on a single-document view that
+    takes a ``doc_id`` argument; answers ``If-None-Match`` and
+    ``If-Modified-Since`` with a 304 before the view fetches or transforms
+    the document.  ``variant`` distinguishes the ETags of the different
+    representations of a document (display, xml, download); it may be a
+    function of the request, for views whose representation depends on the
+    request (e.g. the negotiated content-encoding).'''
+
+    def etag(request, doc_id, *args, **kwargs):
+        digest = document_validators(request, doc_id)[1]
+        if digest:
+            return '%s-%s' % (digest, variant(request) if callable(variant) else variant)
+
+    def last_modified(request, doc_id, *args, **kwargs):
+        return document_validators(request, doc_id)[0]
+
+    return condition(etag_func=etag, last_modified_func=last_modified)
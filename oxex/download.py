@@ -0,0 +1,113 @@
+import re
+import time
+import zlib
+
+import requests
+from django.http import StreamingHttpResponse
+
+from eulexistdb.exceptions import DoesNotExist, ExistDBException
+
+from oxex.existdb import get_exist_db
+from oxex.instrumentation import record_query
+
+#: size of the chunks read from eXist and passed on to the client
+CHUNK_SIZE = 64 * 1024
+
+# content-encodings we can produce, in order of preference
+ENCODINGS = ['gzip', 'deflate']
+
+_accept_encoding_re = re.compile(r'\s*([^\s;,]+)\s*(?:;\s*q\s*=\s*([0-9.]+))?')
+
+
+def accepted_encoding(request):
+    '''Choose a content-encoding (gzip or deflate) based on the request
+    ``Accept-Encoding`` header; returns None if neither is acceptable.'''
+    header = request.META.get('HTTP_ACCEPT_ENCODING', '')
+    quality = {}
+    for item in header.split(','):
+        match = _accept_encoding_re.match(item)
+        if match:
+            try:
+                quality[match.group(1).lower()] = float(match.group(2) or 1)
+            except ValueError:
+                continue
+    best = None
+    for encoding in ENCODINGS:
+        q = quality.get(encoding, quality.get('*', 0))
+        if q > 0 and (best is None or q > quality.get(best, quality.get('*', 0))):
+            best = encoding
+    return best
+
+
+def download_variant(request):
+    '''ETag variant for a document download: each content-encoding, and
+    the pretty-printed download, is a different representation.'''
+    if 'pretty' in request.GET:
+        return 'download-pretty'
+    return 'download-%s' % (accepted_encoding(request) or 'identity')
+
+
+def compress_chunks(chunks, encoding):
+    '''Compress an iterable of byte strings incrementally with gzip or
+    (zlib-wrapped) deflate, as used for HTTP content-encoding.'''
+    if encoding == 'gzip':
+        wbits = 16 + zlib.MAX_WBITS
+    else:
+        wbits = zlib.MAX_WBITS
+    compressor = zlib.compressobj(6, zlib.DEFLATED, wbits)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def stream_document(path, chunk_size=CHUNK_SIZE):
+    '''Open a stored document in eXist for streaming over the REST API,
+    without indentation.  Returns the :mod:`requests` response.  Raises
+    :class:`~eulexistdb.exceptions.DoesNotExist` if there is no document
+    at the path.  The request is recorded by
+    :mod:`~oxex.instrumentation` (eulexistdb only reports queries), timed
+    to the response headers, since the content is streamed afterwards.'''
+    db = get_exist_db()
+    start = time.time()
+    response = db.session.get(db.restapi_path(path), params={'_indent': 'no'},
+                              stream=True, **db.session_opts)
+    size = response.headers.get('Content-Length')
+    record_query('GET %s' % path, time.time() - start, int(size) if size else None)
+    if response.status_code == requests.codes.not_found:
+        response.close()
+        raise DoesNotExist('%s not found' % path)
+    if response.status_code != requests.codes.ok:
+        response.close()
+        raise ExistDBException('Error retrieving %s: %s' % (path, response.status_code))
+    return response
+
+
+def _iter_response(response, chunk_size):
+    try:
+        for chunk in response.iter_content(chunk_size):
+            yield chunk
+    finally:
+        response.close()
+
+
+def document_download(request, path, content_type, chunk_size=CHUNK_SIZE):
+    '''Stream a document stored in eXist to the client in chunks, gzip
+    or deflate compressed if the client accepts it.  The document is
+    never held in memory in full, so the cost of a download is
+    proportional to the bytes sent.'''
+    exist_response = stream_document(path, chunk_size)
+    content = _iter_response(exist_response, chunk_size)
+    encoding = accepted_encoding(request)
+    if encoding is not None:
+        content = compress_chunks(content, encoding)
+
+    response = StreamingHttpResponse(content, content_type=content_type)
+    response['Vary'] = 'Accept-Encoding'
+    if encoding is not None:
+        response['Content-Encoding'] = encoding
+    elif 'content-length' in exist_response.headers and \
+            'content-encoding' not in exist_response.headers:
+        response['Content-Length'] = exist_response.headers['content-length']
+    return response
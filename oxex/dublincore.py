@@ -0,0 +1,100 @@
+import hashlib
+import logging
+
+from django.conf import settings
+from django.core.cache import cache
+from eulxml.xmlmap.dc import DublinCore
+
+from oxex.cache import collection_generation
+from oxex.models import DocTitle
+
+logger = logging.getLogger(__name__)
+
+# DublinCore fields included in a record, in dc_meta.html order
+DC_FIELDS = ('title', 'creator_list', 'contributor_list', 'subject_list', 'publisher',
+             'date', 'rights', 'source', 'description', 'identifier', 'coverage_list',
+             'relation_list')
+
+
+def dc_record(doc):
+    '''Dublin Core record for a :class:`~oxex.models.DocTitle`, from
+    :meth:`~oxex.models.DocTitle.dc_fields`: a dictionary of the
+    :data:`DC_FIELDS` (lists for the repeating fields), with the
+    serialized ``oai_dc`` XML in ``xml``.  If the fields cannot be read
+    (e.g. a document without a TEI header), a warning is logged and the
+    record is empty.'''
+    try:
+        dc = doc.dc_fields()
+    except Exception as err:
+        logger.warning('Error reading Dublin Core fields for %s: %s', doc.id, err)
+        dc = DublinCore()
+    record = {}
+    for field in DC_FIELDS:
+        value = getattr(dc, field)
+        record[field] = list(value) if field.endswith('_list') else value
+    record['xml'] = dc.serialize().decode('utf-8')
+    return record
+
+
+class DCRecordStore(object):
+    '''Store of Dublin Core records for documents (see :meth:`dc_record`),
+    in the Django cache keyed on document id and collection generation,
+    so the TEI header is only walked once per document until the
+    collection changes.  Records are built on first access, or can be
+    added at ingest with :meth:`populate`.  Configure the timeout with
+    ``OXEX_DC_CACHE_TIMEOUT`` (seconds, default one week).'''
+
+    prefix = 'oxex:dc'
+
+    @property
+    def timeout(self):
+        return getattr(settings, 'OXEX_DC_CACHE_TIMEOUT', 60 * 60 * 24 * 7)
+
+    def key(self, doc_id, generation=None):
+        digest = hashlib.md5(doc_id.encode('utf-8')).hexdigest()
+        return '%s:%s:%s' % (self.prefix, generation or collection_generation(), digest)
+
+    def get(self, doc_id, doc=None):
+        '''Dublin Core record for a single document.  On a miss, the record
+        is built from ``doc`` if given, or from the document retrieved
+        from eXist.  Raises :class:`~eulexistdb.exceptions.DoesNotExist`
+        if there is no such document.'''
+        key = self.key(doc_id)
+        record = cache.get(key)
+        if record is None:
+            if doc is None:
+                doc = DocTitle.objects.get(id=doc_id)
+            record = dc_record(doc)
+            cache.set(key, record, self.timeout)
+        return record
+
+    def get_many(self, doc_ids):
+        '''Dublin Core records for a list of documents, as a dictionary
+        keyed on document id.  Records not in the store are built from
+        the documents retrieved in a single eXist query; ids with no
+        document are left out.'''
+        generation = collection_generation()
+        keys = dict((self.key(doc_id, generation), doc_id) for doc_id in doc_ids)
+        records = dict((keys[key], record) for key, record
+                       in cache.get_many(keys.keys()).iteritems())
+        missing = [doc_id for doc_id in doc_ids if doc_id not in records]
+        if missing:
+            new_records = {}
+            for doc in DocTitle.objects.filter(id__in=missing):
+                records[doc.id] = new_records[self.key(doc.id, generation)] = dc_record(doc)
+            cache.set_many(new_records, self.timeout)
+        return records
+
+    def populate(self, docs):
+        '''Add records for a list of documents (e.g. TEI files loaded at
+        ingest) to the store for the current generation.'''
+        generation = collection_generation()
+        records = {}
+        for doc in docs:
+            records[self.key(doc.id, generation)] = dc_record(doc)
+        cache.set_many(records, self.timeout)
+        return len(records)
+
+
+#: process-wide Dublin Core record store
+dc_records = DCRecordStore()
@@ -0,0 +1,88 @@
+import threading
+
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+from eulexistdb import manager
+from eulexistdb.db import ExistDB
+from eulexistdb.query import QuerySet
+
+_lock = threading.Lock()
+_db = None
+
+
+def exist_timeout():
+    '''Connect and read timeouts for eXist requests, as a tuple; configure
+    with ``OXEX_EXISTDB_CONNECT_TIMEOUT`` and the eulexistdb
+    ``EXISTDB_TIMEOUT`` setting (read timeout).'''
+    return (getattr(settings, 'OXEX_EXISTDB_CONNECT_TIMEOUT', 5),
+            getattr(settings, 'EXISTDB_TIMEOUT', None))
+
+
+def get_exist_db():
+    '''Shared :class:`~eulexistdb.db.ExistDB` for this worker process.
+
+    Unlike a new ``ExistDB`` for every query, which opens fresh HTTP
+    connections each time, the shared instance keeps a pool of keep-alive
+    connections to eXist that are reused across queries and requests.
+    ``OXEX_EXISTDB_MAX_CONNECTIONS`` limits the number of connections kept
+    in the pool.  When all of them are in use, a request opens an extra
+    connection rather than waiting (with no bound) for one to be returned;
+    the extra connection is closed after use, with a warning logged by
+    ``urllib3.connectionpool``, so frequent warnings mean the pool is too
+    small.'''
+    global _db
+    if _db is None:
+        with _lock:
+            if _db is None:
+                db = ExistDB(keep_alive=True, timeout=exist_timeout())
+                max_connections = getattr(settings, 'OXEX_EXISTDB_MAX_CONNECTIONS', 10)
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_connections,
+                                      pool_block=False)
+                db.session.mount('http://', adapter)
+                db.session.mount('https://', adapter)
+                _db = db
+    return _db
+
+
+def reset_exist_db():
+    '''Discard the shared :class:`~eulexistdb.db.ExistDB`; the next call
+    to :meth:`get_exist_db` creates a new one.  Use in a child process
+    after a fork, so it does not share connections with its parent.'''
+    global _db
+    with _lock:
+        _db = None
+
+
+def pool_stats():
+    '''Statistics for the eXist connection pool of this worker: the
+    configured maximum and, for each pool, the number of connections
+    opened, the number of requests made and the number of idle
+    connections.'''
+    db = get_exist_db()
+    adapter = db.session.get_adapter(db.exist_url)
+    stats = {'max_connections': getattr(settings, 'OXEX_EXISTDB_MAX_CONNECTIONS', 10),
+             'pools': []}
+    pools = adapter.poolmanager.pools
+    for key in pools.keys():
+        pool = pools[key]
+        stats['pools'].append({
+            'host': '%s:%s' % (pool.host, pool.port),
+            'connections': pool.num_connections,
+            'requests': pool.num_requests,
+            # the pool queue is padded with None for connections not yet opened
+            'idle': len([c for c in list(pool.pool.queue) if c is not None])
+                    if pool.pool is not None else 0,
+        })
+    return stats
+
+
+class Manager(manager.Manager):
+    '''eulexistdb :class:`~eulexistdb.manager.Manager` that queries eXist
+    through the pooled connections of :meth:`get_exist_db`.'''
+
+    def get_query_set(self):
+        fulltext_opts = getattr(settings, 'EXISTDB_FULLTEXT_OPTIONS', {})
+        return QuerySet(model=self.model, xpath=self.xpath, using=get_exist_db(),
+                        collection=settings.EXISTDB_ROOT_COLLECTION,
+                        fulltext_options=fulltext_opts)
@@ -0,0 +1,168 @@
+from array import array
+import logging
+import threading
+
+from django.conf import settings
+
+from oxex.cache import collection_generation
+from oxex.fulltext import intersect
+from oxex.models import DocTitle
+from oxex.summary import DocSummary, SUMMARY_FIELDS
+
+logger = logging.getLogger(__name__)
+
+#: browse facets, as (request parameter, label, DocTitle field)
+FACETS = (
+    ('subject', 'Subject', 'lcsh_subjects'),
+    ('geography', 'Geography', 'geo_coverage'),
+    ('date', 'Date of creation', 'creation_date'),
+)
+
+
+def facet_values(doc, field):
+    'Distinct non-empty values of a facet field for a document, in order.'
+    values = getattr(doc, field)
+    if values is None or isinstance(values, basestring):
+        values = [values]
+    distinct = []
+    for value in values:
+        value = (value or '').strip()
+        if value and value not in distinct:
+            distinct.append(value)
+    return distinct
+
+
+class FacetIndex(object):
+    '''In-process index of the browse facets (see :data:`FACETS`) for
+    every document in the collection, built in a single pass over the
+    documents retrieved in one eXist query, and rebuilt the first time it
+    is used after the collection generation changes (i.e., after each
+    ingest).
+
+    For each facet value, the index keeps a sorted array of the positions
+    of its documents in browse (date) order, along with the number of
+    documents.  Browsing by one or more facet values intersects those
+    arrays, so filtered results and their counts come from the index
+    rather than a new eXist query.  Enable faceted browse with the
+    ``OXEX_FACET_INDEX`` setting.'''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # generation, summaries in date order, facet values by position,
+        # positions by facet and value, counts for the whole collection
+        self._state = (None, (), (), {}, [])
+
+    @property
+    def enabled(self):
+        return getattr(settings, 'OXEX_FACET_INDEX', False)
+
+    def load(self):
+        generation = collection_generation()
+        fields = [field for name, label, field in FACETS]
+        docs = DocTitle.objects.only(*(SUMMARY_FIELDS + tuple(fields))).order_by('date')
+        docs.default_chunk_size = 1000
+
+        strings = {}
+        summaries = []
+        doc_values = []
+        postings = dict((name, {}) for name, label, field in FACETS)
+        for position, doc in enumerate(docs):
+            summaries.append(DocSummary(*[strings.setdefault(v, v) for v in
+                                          (doc.id, doc.title, doc.date, doc.author)]))
+            values = []
+            for name, label, field in FACETS:
+                for value in facet_values(doc, field):
+                    value = strings.setdefault(value, value)
+                    postings[name].setdefault(value, array('I')).append(position)
+                    values.append((name, value))
+            doc_values.append(tuple(values))
+        counts = self._counts(dict(((name, value), len(positions))
+                                   for name in postings
+                                   for value, positions in postings[name].iteritems()))
+
+        with self._lock:
+            self._state = (generation, tuple(summaries), tuple(doc_values), postings, counts)
+        logger.debug('loaded facet index of %d documents for generation %s',
+                     len(summaries), generation)
+        return summaries
+
+    def _current(self):
+        if self._state[0] != collection_generation():
+            self.load()
+        return self._state
+
+    def _counts(self, counts, selected=None):
+        # facets for display: for each facet, the values with the number
+        # of documents, most frequent first
+        selected = selected or {}
+        facets = []
+        for name, label, field in FACETS:
+            values = sorted(((value, count) for (facet, value), count in counts.iteritems()
+                             if facet == name),
+                            key=lambda (value, count): (-count, value.lower()))
+            facets.append({
+                'name': name, 'label': label,
+                'values': [{'value': value, 'count': count,
+                            'selected': value in selected.get(name, [])}
+                           for value, count in values],
+            })
+        return facets
+
+    def positions(self, selected):
+        '''Sorted positions of the documents with all of the selected facet
+        values (a dictionary of lists of values by facet name), or None if
+        nothing is selected.  Unknown facet names are ignored.'''
+        postings = self._current()[3]
+        lists = [postings[name].get(value, array('I'))
+                 for name, label, field in FACETS
+                 for value in selected.get(name, [])]
+        if not lists:
+            return None
+        # intersect the shortest lists first
+        lists.sort(key=len)
+        result = lists[0]
+        for positions in lists[1:]:
+            if not result:
+                break
+            result = intersect(result, positions)
+        return result
+
+    def documents(self, selected=None):
+        '''Document summaries, in date order, with all of the selected
+        facet values; all documents if nothing is selected.'''
+        summaries = self._current()[1]
+        positions = self.positions(selected or {})
+        if positions is None:
+            return summaries
+        return tuple(summaries[p] for p in positions)
+
+    def facets(self, selected=None):
+        '''Facet values and document counts, either for the whole collection
+        or for the documents with the selected facet values.  Collection
+        counts are computed when the index is loaded; counts for a
+        selection take a single pass over the selected documents.'''
+        generation, summaries, doc_values, postings, counts = self._current()
+        positions = self.positions(selected or {})
+        if positions is None:
+            return counts
+        selected_counts = {}
+        for p in positions:
+            for value in doc_values[p]:
+                selected_counts[value] = selected_counts.get(value, 0) + 1
+        return self._counts(selected_counts, selected)
+
+
+#: process-wide browse facet index
+facet_index = FacetIndex()
+
+
+def warm_facet_index():
+    '''Load the facet index at worker start, if enabled.  Errors are logged
+    rather than raised, so an unavailable eXist does not prevent the worker
+    from starting; the index is loaded on first use instead.'''
+    if not facet_index.enabled:
+        return
+    try:
+        facet_index.load()
+    except Exception:
+        logger.exception('Could not load browse facet index')
@@ -0,0 +1,404 @@
+from array import array
+from bisect import bisect_left
+from fnmatch import fnmatchcase
+import heapq
+import logging
+import re
+import threading
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from eulxml import xmlmap
+from eulxml.xmlmap.teimap import TEI_NAMESPACE
+
+from oxex.cache import collection_generation
+from oxex.ingest import tei_files
+from oxex.models import DocTitle
+from oxex.summary import DocSummary
+
+logger = logging.getLogger(__name__)
+
+TEI = '{%s}' % TEI_NAMESPACE
+
+# text of the nodes each search filter queries, as in the DocTitle fields;
+# keyword searches query the whole document
+FIELD_XPATHS = {
+    'keyword': '/tei:TEI',
+    'title': 'tei:teiHeader/tei:fileDesc/tei:titleStmt/tei:title',
+    'author': 'tei:teiHeader/tei:fileDesc/tei:titleStmt/tei:author/tei:name/tei:choice/tei:sic',
+    'date': 'tei:teiHeader/tei:fileDesc/tei:titleStmt/tei:title/tei:date',
+}
+
+# eulexistdb filters used by searchbox and the field each one searches
+FILTER_FIELDS = {
+    'fulltext_terms': 'keyword',
+    'title__fulltext_terms': 'title',
+    'author__fulltext_terms': 'author',
+    'date__fulltext_terms': 'date',
+}
+
+# excluded from the Lucene index in exist_index.xconf
+IGNORED_ELEMENTS = set(TEI + name for name in
+    ['publicationStmt', 'seriesStmt', 'sourceDesc', 'encodingDesc', 'revisionDesc'])
+
+# stop words removed by the Lucene StandardAnalyzer
+STOP_WORDS = frozenset([
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'but', 'by', 'for', 'if', 'in',
+    'into', 'is', 'it', 'no', 'not', 'of', 'on', 'or', 'such', 'that', 'the',
+    'their', 'then', 'there', 'these', 'they', 'this', 'to', 'was', 'will', 'with'])
+
+_token_re = re.compile(r"\w+(?:'\w+)*", re.UNICODE)
+_query_re = re.compile(r'\s*(?:(\(|\))|([-+!]?)"([^"]*)"|([-+!]?)([^\s()"]+)|("))', re.UNICODE)
+
+
+class SearchQueryError(ValueError):
+    'A search query could not be parsed or evaluated.'
+
+
+class TooManyTermsError(SearchQueryError):
+    'A wildcard search term expands to more than the maximum number of terms.'
+
+    def __init__(self, term, max_terms):
+        self.term = term
+        self.max_terms = max_terms
+        super(TooManyTermsError, self).__init__(
+            '"%s" matches too many terms (more than %d)' % (term, max_terms))
+
+
+def tokenize(text):
+    '''Split text into lower-case index terms, similar to the Lucene
+    StandardAnalyzer configured in ``exist_index.xconf``.'''
+    return [t for t in _token_re.findall(text.lower()) if t not in STOP_WORDS]
+
+
+def text_content(node, parts=None):
+    '''Text of an element and its descendants, leaving out the elements
+    excluded from the index.'''
+    if parts is None:
+        parts = []
+    if node.tag in IGNORED_ELEMENTS:
+        return parts
+    if node.text:
+        parts.append(node.text)
+    for child in node:
+        # skip comments and processing instructions, but not their tails
+        if isinstance(child.tag, basestring):
+            text_content(child, parts)
+        if child.tail:
+            parts.append(child.tail)
+    return parts
+
+
+def intersect(a, b):
+    'Intersection of two sorted postings lists.'
+    if len(a) > len(b):
+        a, b = b, a
+    result = array('I')
+    i = 0
+    for n in a:
+        # b is usually much longer; search forward from the last match
+        i = bisect_left(b, n, i)
+        if i == len(b):
+            break
+        if b[i] == n:
+            result.append(n)
+    return result
+
+
+def union(lists):
+    'Union of sorted postings lists.'
+    result = array('I')
+    last = None
+    for n in heapq.merge(*lists):
+        if n != last:
+            result.append(n)
+            last = n
+    return result
+
+
+def difference(a, b):
+    'Postings in sorted list ``a`` that are not in sorted list ``b``.'
+    result = array('I')
+    for n in a:
+        i = bisect_left(b, n)
+        if i == len(b) or b[i] != n:
+            result.append(n)
+    return result
+
+
+class FulltextIndex(object):
+    '''In-process inverted index over a directory of TEI files, an
+    alternative to eXist full-text queries for ``searchbox``.
+
+    The index has the same fields as the eXist Lucene configuration
+    (see :data:`FIELD_XPATHS`); each term maps to a postings list, a
+    sorted :class:`array.array` of document numbers.  Documents are
+    numbered in title order, so matches come out of the postings lists
+    already sorted as search results are displayed.
+
+    Each field also has a sorted term dictionary, used to expand wildcard
+    terms: a term like ``resign*`` only looks at the range of terms that
+    start with ``resign``, and an expansion to more than
+    ``OXEX_WILDCARD_MAX_TERMS`` terms (default 1024) is an error rather
+    than a search over most of the index.  As in eXist, wildcards at the
+    start of a term are only allowed if the ``leading-wildcard`` option is
+    set in ``EXISTDB_FULLTEXT_OPTIONS``.  (Searches on the default eXist
+    backend are not expanded here; eXist expands wildcards itself, up to
+    the Lucene clause limit; see :meth:`oxex.search.too_many_clauses`.)
+
+    Enable with ``OXEX_SEARCH_BACKEND = 'local'`` and set
+    ``OXEX_TEI_DIRECTORY`` to the directory of TEI files loaded into eXist.
+    The index is rebuilt the first time it is used after the collection
+    generation changes.
+    '''
+
+    def __init__(self, directory=None):
+        self._directory = directory
+        self._lock = threading.Lock()
+        # held while the index is rebuilt, so concurrent requests after a
+        # new generation wait for one rebuild rather than each starting one
+        self._build_lock = threading.Lock()
+        # generation, documents in title order, postings by field and
+        # term, sorted terms by field
+        self._state = (None, (), {}, {})
+
+    @property
+    def enabled(self):
+        return getattr(settings, 'OXEX_SEARCH_BACKEND', 'exist') == 'local'
+
+    @property
+    def directory(self):
+        if self._directory is not None:
+            return self._directory
+        return getattr(settings, 'OXEX_TEI_DIRECTORY', None)
+
+    @property
+    def default_operator(self):
+        # same default as eXist full-text queries, unless configured
+        options = getattr(settings, 'EXISTDB_FULLTEXT_OPTIONS', {})
+        return options.get('default-operator', 'or').lower()
+
+    @property
+    def leading_wildcard(self):
+        options = getattr(settings, 'EXISTDB_FULLTEXT_OPTIONS', {})
+        return options.get('leading-wildcard', 'no').lower() == 'yes'
+
+    @property
+    def max_terms(self):
+        # the Lucene default maximum number of clauses in a query
+        return getattr(settings, 'OXEX_WILDCARD_MAX_TERMS', 1024)
+
+    def build(self, paths=None):
+        '''Index TEI files (by default, all ``.xml`` files in the TEI
+        directory and its subdirectories, as loaded by ``load_tei``) and
+        make the new index current.  Raises
+        :class:`~django.core.exceptions.ImproperlyConfigured` if there is
+        no TEI directory.'''
+        if paths is None:
+            if not self.directory:
+                raise ImproperlyConfigured('OXEX_TEI_DIRECTORY is required for ' +
+                                           'OXEX_SEARCH_BACKEND = "local"')
+            paths = tei_files(self.directory)
+        generation = collection_generation()
+
+        docs = []
+        for path in paths:
+            doc = xmlmap.load_xmlobject_from_file(path, DocTitle)
+            if doc.node.tag != TEI + 'TEI':
+                # not a TEI document; eXist queries would not find it either
+                logger.warning('skipping %s: not a TEI document', path)
+                continue
+            fields = {}
+            for field, xpath in FIELD_XPATHS.iteritems():
+                terms = set()
+                for node in doc.node.xpath(xpath, namespaces=DocTitle.ROOT_NAMESPACES):
+                    terms.update(tokenize(' '.join(text_content(node))))
+                fields[field] = terms
+            docs.append((doc.title or '', DocSummary(doc.id, doc.title, doc.date, doc.author),
+                         fields))
+        docs.sort(key=lambda d: d[0])
+
+        postings = dict((field, {}) for field in FIELD_XPATHS)
+        for number, (title, summary, fields) in enumerate(docs):
+            for field, terms in fields.iteritems():
+                for term in terms:
+                    postings[field].setdefault(term, array('I')).append(number)
+
+        summaries = tuple(d[1] for d in docs)
+        terms = dict((field, tuple(sorted(postings[field]))) for field in postings)
+        with self._lock:
+            self._state = (generation, summaries, postings, terms)
+        logger.debug('built full-text index of %d documents for generation %s',
+                     len(summaries), generation)
+        return summaries
+
+    def _current(self):
+        if self._state[0] != collection_generation():
+            with self._build_lock:
+                # another request may have rebuilt the index while we waited
+                if self._state[0] != collection_generation():
+                    self.build()
+        return self._state
+
+    def expand(self, field, pattern):
+        '''Expand a term with ``*`` and ``?`` wildcards to the matching
+        terms in a field, using the sorted term dictionary.  Raises
+        :class:`TooManyTermsError` if there are more matching terms than
+        the configured maximum.'''
+        terms = self._current()[3][field]
+        prefix = re.split(r'[*?]', pattern, 1)[0]
+        if not prefix and not self.leading_wildcard:
+            raise SearchQueryError('Cannot parse "%s": wildcard at the start of a term' % pattern)
+        # only the terms sharing the literal prefix can match
+        start = bisect_left(terms, prefix)
+        end = bisect_left(terms, prefix + u'\uffff', start) if prefix else len(terms)
+        exact_prefix = pattern == prefix + '*'
+        max_terms = self.max_terms
+        matches = []
+        for i in xrange(start, end):
+            if exact_prefix or fnmatchcase(terms[i], pattern):
+                if len(matches) == max_terms:
+                    raise TooManyTermsError(pattern, max_terms)
+                matches.append(terms[i])
+        return matches
+
+    def term_postings(self, field, term):
+        '''Postings for a single query term in a field; terms with ``*``
+        or ``?`` are expanded with :meth:`expand`.'''
+        postings = self._current()[2][field]
+        if '*' in term or '?' in term:
+            return union([postings[t] for t in self.expand(field, term)])
+        return postings.get(term, array('I'))
+
+    def _clause_postings(self, field, text, wildcard=True):
+        # a clause may analyze to several terms ("1892-02-06", or a
+        # phrase); documents must contain all of them
+        if wildcard and ('*' in text or '?' in text):
+            terms = [t for t in re.split(r'[^\w*?]+', text.lower(), flags=re.UNICODE)
+                     if t and t not in STOP_WORDS]
+        else:
+            terms = tokenize(text)
+        if not terms:
+            # only stop words; the clause is dropped, as in Lucene
+            return None
+        result = None
+        for term in terms:
+            postings = self.term_postings(field, term)
+            result = postings if result is None else intersect(result, postings)
+        return result
+
+    def _parse(self, query, pos=0, depth=0):
+        # parse clauses up to a closing parenthesis; returns a list of
+        # (occur, clause) tuples and the position after the clauses
+        clauses = []
+        pending = None
+        while True:
+            match = _query_re.match(query, pos)
+            if match is None or match.end() == pos:
+                if query[pos:].strip():
+                    raise SearchQueryError('Cannot parse "%s"' % query)
+                if depth:
+                    raise SearchQueryError('Cannot parse "%s": missing )' % query)
+                break
+            pos = match.end()
+            paren, phrase_prefix, phrase, term_prefix, term, quote = match.groups()
+            if quote:
+                raise SearchQueryError('Cannot parse "%s": unbalanced quotes' % query)
+            if paren == ')':
+                if not depth:
+                    raise SearchQueryError('Cannot parse "%s": unbalanced )' % query)
+                break
+            if term in ('AND', '&&', 'OR', '||', 'NOT', '!'):
+                # a conjunction also applies to the preceding clause
+                if clauses and term in ('AND', '&&') and clauses[-1][0] == 'should':
+                    clauses[-1] = ('must', clauses[-1][1])
+                elif clauses and term in ('OR', '||') and clauses[-1][0] == 'must':
+                    clauses[-1] = ('should', clauses[-1][1])
+                pending = {'AND': 'must', '&&': 'must', 'OR': 'should', '||': 'should',
+                           'NOT': 'must_not', '!': 'must_not'}[term]
+                continue
+
+            if paren == '(':
+                clause, pos = self._parse(query, pos, depth + 1)
+                prefix = ''
+            elif phrase is not None:
+                clause, prefix = ('phrase', phrase), phrase_prefix
+            else:
+                clause, prefix = ('term', term), term_prefix
+
+            if prefix == '+':
+                occur = 'must'
+            elif prefix in ('-', '!'):
+                occur = 'must_not'
+            elif pending:
+                occur = pending
+            else:
+                occur = 'must' if self.default_operator == 'and' else 'should'
+            pending = None
+            clauses.append((occur, clause))
+        if pending:
+            raise SearchQueryError('Cannot parse "%s": missing term' % query)
+        return clauses, pos
+
+    def _evaluate(self, field, clauses):
+        must, should, must_not = [], [], []
+        for occur, clause in clauses:
+            if isinstance(clause, list):
+                postings = self._evaluate(field, clause)
+            else:
+                postings = self._clause_postings(field, clause[1], clause[0] == 'term')
+            if postings is None:
+                continue
+            {'must': must, 'should': should, 'must_not': must_not}[occur].append(postings)
+
+        if must:
+            result = must[0]
+            for postings in must[1:]:
+                result = intersect(result, postings)
+        elif should:
+            result = union(should)
+        else:
+            # purely negative queries match nothing, as in Lucene
+            return array('I')
+        for postings in must_not:
+            result = difference(result, postings)
+        return result
+
+    def query(self, field, query):
+        '''Postings for the documents matching a full-text query on one
+        field.  Supports terms, quoted phrases (matching documents that
+        contain all of the words), ``*`` and ``?`` wildcards, ``+`` and
+        ``-`` prefixes, ``AND``, ``OR``, ``NOT`` and parentheses.'''
+        clauses = self._parse(query)[0]
+        return self._evaluate(field, clauses)
+
+    def search(self, filters):
+        '''Documents matching eulexistdb full-text filters, as generated by
+        :meth:`oxex.search.search_options`; returns a tuple of
+        :class:`~oxex.summary.DocSummary` in title order.'''
+        summaries = self._current()[1]
+        result = None
+        for name, query in filters.iteritems():
+            if name not in FILTER_FIELDS:
+                raise SearchQueryError('Unsupported search filter %s' % name)
+            matches = self.query(FILTER_FIELDS[name], query)
+            result = matches if result is None else intersect(result, matches)
+        if result is None:
+            return ()
+        return tuple(summaries[n] for n in result)
+
+
+#: process-wide full-text index
+fulltext_index = FulltextIndex()
+
+
+def warm_fulltext_index():
+    '''Build the full-text index at worker start, if enabled.  Errors are
+    logged rather than raised; the index is built on first use instead.'''
+    if not fulltext_index.enabled:
+        return
+    try:
+        fulltext_index.build()
+    except Exception:
+        logger.exception('Could not build full-text index')
@@ -0,0 +1,263 @@
+import hashlib
+import json
+import logging
+from multiprocessing.pool import ThreadPool
+import os
+import time
+
+from django.conf import settings
+import requests
+
+from eulexistdb.db import ExistDBException
+from eulxml import xmlmap
+
+from oxex.cache import invalidate_collection
+from oxex.dublincore import dc_records
+from oxex.existdb import get_exist_db
+from oxex.models import DocTitle
+
+logger = logging.getLogger(__name__)
+
+INDEX_CONFIG = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                            'exist_index.xconf')
+
+#: default name of the ingest manifest, in the directory being loaded
+MANIFEST = '.oxex-ingest.json'
+
+
+def index_config_file():
+    '''eXist index configuration for the collection: the eulexistdb
+    ``EXISTDB_INDEX_CONFIGFILE`` setting, or ``exist_index.xconf``.'''
+    return getattr(settings, 'EXISTDB_INDEX_CONFIGFILE', None) or INDEX_CONFIG
+
+
+def tei_files(directory):
+    'Paths of all ``.xml`` files in a directory and its subdirectories, sorted.'
+    paths = []
+    for dirpath, dirnames, filenames in os.walk(directory):
+        paths.extend(os.path.join(dirpath, f) for f in filenames if f.endswith('.xml'))
+    return sorted(paths)
+
+
+def exist_path(collection, directory, path):
+    'eXist path for a file, relative to the directory being loaded.'
+    relpath = os.path.relpath(path, directory).replace(os.sep, '/')
+    return '%s/%s' % (collection.rstrip('/'), relpath)
+
+
+def file_hash(path):
+    'SHA-1 hash of the contents of a file.'
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as infile:
+        for block in iter(lambda: infile.read(65536), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+class IngestManifest(object):
+    '''Persistent record of the files loaded into an eXist collection: for
+    each file (by path relative to the directory loaded), its content hash
+    and eXist path, with the collection generation after the last load.'''
+
+    def __init__(self, path, collection):
+        self.path = path
+        self.collection = collection
+        self.generation = None
+        self.files = {}
+        if os.path.exists(path):
+            with open(path) as manifest_file:
+                data = json.load(manifest_file)
+            # a manifest for another collection says nothing about this one
+            if data.get('collection') == collection:
+                self.generation = data.get('generation')
+                self.files = data.get('files', {})
+
+    @property
+    def exists(self):
+        return bool(self.files)
+
+    def save(self):
+        # write to a temporary file first, so an interrupted load does not
+        # leave a truncated manifest
+        tmp = '%s.tmp' % self.path
+        with open(tmp, 'w') as manifest_file:
+            json.dump({'collection': self.collection, 'generation': self.generation,
+                       'files': self.files}, manifest_file, indent=2, sort_keys=True)
+        os.rename(tmp, self.path)
+
+
+def upload(path, destination, db=None):
+    '''Store a file in eXist, creating or replacing the document at the
+    destination path; returns the number of bytes uploaded.'''
+    db = db or get_exist_db()
+    with open(path, 'rb') as infile:
+        content = infile.read()
+    # REST PUT on the pooled session; the document is replaced if it exists
+    response = db.session.put(db.restapi_path(destination), content,
+                              headers={'Content-Type': 'application/xml'},
+                              **db.session_opts)
+    if response.status_code not in (requests.codes.created, requests.codes.ok):
+        raise ExistDBException('Error storing %s: %s %s' %
+                               (destination, response.status_code, response.reason))
+    return len(content)
+
+
+class IngestReport(object):
+    'Counts, sizes, timing and failures for a bulk load into eXist.'
+
+    def __init__(self):
+        self.start = time.time()
+        self.end = None
+        self.documents = 0
+        self.bytes = 0
+        self.unchanged = 0
+        self.removed = 0
+        self.generation = None
+        self.failures = []
+
+    def finish(self):
+        self.end = time.time()
+
+    @property
+    def seconds(self):
+        return (self.end or time.time()) - self.start
+
+    @property
+    def docs_per_second(self):
+        return self.documents / self.seconds if self.seconds else 0
+
+    def as_dict(self):
+        return {'documents': self.documents, 'bytes': self.bytes,
+                'unchanged': self.unchanged, 'removed': self.removed,
+                'generation': self.generation, 'failures': self.failures,
+                'seconds': round(self.seconds, 3),
+                'docs_per_second': round(self.docs_per_second, 2)}
+
+
+def upload_files(uploads, threads=4, report=None):
+    '''Upload files to eXist with a bounded pool of threads.  ``uploads``
+    is a list of (file path, eXist path) tuples.  Failures are recorded
+    in the report rather than raised, so one bad file does not stop the
+    load.  Returns an :class:`IngestReport`; the file paths uploaded are
+    in ``report.loaded``.'''
+    report = report or IngestReport()
+    report.loaded = []
+    db = get_exist_db()
+
+    def _upload(item):
+        path, destination = item
+        try:
+            return path, upload(path, destination, db), None
+        except Exception as err:
+            return path, 0, '%s: %s' % (err.__class__.__name__, err)
+
+    pool = ThreadPool(threads)
+    try:
+        for path, size, error in pool.imap_unordered(_upload, uploads):
+            if error:
+                logger.error('Error loading %s: %s', path, error)
+                report.failures.append({'path': path, 'error': error})
+            else:
+                report.documents += 1
+                report.bytes += size
+                report.loaded.append(path)
+    finally:
+        pool.close()
+        pool.join()
+    return report
+
+
+def populate_dc_records(paths):
+    '''Add Dublin Core records for loaded TEI files to the record store,
+    so they are not built from eXist on first access.'''
+    docs = []
+    for path in paths:
+        try:
+            docs.append(xmlmap.load_xmlobject_from_file(path, DocTitle))
+        except Exception as err:
+            logger.error('Error reading %s for Dublin Core: %s', path, err)
+    return dc_records.populate(doc for doc in docs if doc.id)
+
+
+def load_directory(directory, collection=None, threads=4, reindex=True,
+                   manifest=None, full=False):
+    '''Load a directory of TEI files into an eXist collection (by default,
+    the configured collection), with a bounded pool of upload threads.
+
+    Loads are incremental: an :class:`IngestManifest` (by default
+    :data:`MANIFEST` in the directory) records the content hash and eXist
+    path of every file loaded.  When there is a manifest for the
+    collection, only new and changed files are uploaded, and documents
+    for files that have been removed are deleted from eXist; eXist
+    indexes the changed documents as they are stored.
+
+    Otherwise, or when ``full`` is true, every file is uploaded.  When
+    ``reindex`` is true, the index configuration is removed while the
+    files are uploaded, so eXist does not index each document as it is
+    stored; the configuration from :meth:`index_config_file` is then
+    installed and the collection reindexed once, even if the upload fails.
+
+    If anything changed, a new collection generation is started and
+    recorded in the manifest, and the Dublin Core record store is
+    populated for the new generation.  Returns an :class:`IngestReport`.'''
+    collection = collection or settings.EXISTDB_ROOT_COLLECTION
+    manifest = IngestManifest(manifest or os.path.join(directory, MANIFEST), collection)
+    incremental = manifest.exists and not full
+    db = get_exist_db()
+    report = IngestReport()
+
+    if not db.hasCollection(collection):
+        db.createCollection(collection)
+    has_index = db.hasCollectionIndex(collection)
+    if incremental:
+        reindex = False
+        # changed documents are indexed as they are stored
+        if not has_index:
+            with open(index_config_file()) as config:
+                db.loadCollectionIndex(collection, config)
+
+    current = {}
+    for path in tei_files(directory):
+        relpath = os.path.relpath(path, directory)
+        current[relpath] = {'sha1': file_hash(path),
+                            'path': exist_path(collection, directory, path)}
+    if incremental:
+        changed = [relpath for relpath, entry in current.iteritems()
+                   if manifest.files.get(relpath, {}).get('sha1') != entry['sha1']]
+    else:
+        changed = list(current)
+    report.unchanged = len(current) - len(changed)
+
+    uploads = [(os.path.join(directory, relpath), current[relpath]['path'])
+               for relpath in changed]
+    if reindex and has_index:
+        db.removeCollectionIndex(collection)
+    # the index configuration is restored even if the upload fails
+    try:
+        upload_files(uploads, threads, report)
+        # files that failed keep their previous entry, so they are retried
+        for path in report.loaded:
+            relpath = os.path.relpath(path, directory)
+            manifest.files[relpath] = current[relpath]
+
+        # remove documents for files no longer in the directory
+        for relpath in sorted(set(manifest.files) - set(current)):
+            try:
+                db.removeDocument(manifest.files[relpath]['path'])
+                report.removed += 1
+                del manifest.files[relpath]
+            except ExistDBException as err:
+                logger.error('Error removing %s: %s', manifest.files[relpath]['path'], err)
+                report.failures.append({'path': relpath, 'error': str(err)})
+    finally:
+        if reindex:
+            with open(index_config_file()) as config:
+                db.loadCollectionIndex(collection, config)
+            db.reindexCollection(collection)
+    if report.documents or report.removed or manifest.generation is None:
+        manifest.generation = invalidate_collection()
+        populate_dc_records(os.path.join(directory, relpath) for relpath in manifest.files)
+    report.generation = manifest.generation
+    manifest.save()
+    report.finish()
+    return report
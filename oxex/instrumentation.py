@@ -0,0 +1,148 @@
+from collections import deque
+from functools import wraps
+import re
+import threading
+import time
+
+from django.conf import settings
+
+from eulexistdb import db
+
+_local = threading.local()
+_lock = threading.Lock()
+
+_hits_re = re.compile(r'exist:hits="(\d+)"')
+_count_re = re.compile(r'exist:count="(\d+)"')
+
+#: number of recent requests per view kept for percentiles
+VIEW_HISTORY = 1000
+
+
+class QueryLog(object):
+    '''Rolling in-memory statistics for instrumented views: timings for
+    recent requests to each view, and a log of recent slow eXist queries
+    (slower than ``OXEX_SLOW_QUERY_MS`` milliseconds, default 500; the
+    most recent ``OXEX_SLOW_QUERY_LOG_SIZE`` are kept, default 100).'''
+
+    def __init__(self):
+        self.views = {}
+        self.slow_queries = deque(maxlen=getattr(settings, 'OXEX_SLOW_QUERY_LOG_SIZE', 100))
+
+    @property
+    def slow_threshold(self):
+        return getattr(settings, 'OXEX_SLOW_QUERY_MS', 500)
+
+    def add_query(self, query, view=None):
+        if query['time'] >= self.slow_threshold:
+            entry = dict(query, view=view, timestamp=time.time())
+            with _lock:
+                self.slow_queries.appendleft(entry)
+
+    def add_request(self, view, total_time, queries):
+        with _lock:
+            if view not in self.views:
+                self.views[view] = deque(maxlen=VIEW_HISTORY)
+            self.views[view].append((total_time, sum(q['time'] for q in queries),
+                                     len(queries)))
+
+    def view_stats(self):
+        '''Request count and 50th, 95th and 99th percentile total time,
+        eXist time and number of eXist queries for each view.'''
+        stats = []
+        with _lock:
+            views = dict((name, list(timings)) for name, timings in self.views.iteritems())
+        for name in sorted(views):
+            timings = views[name]
+            view = {'view': name, 'requests': len(timings)}
+            for i, label in enumerate(['total', 'exist', 'queries']):
+                values = sorted(t[i] for t in timings)
+                view[label] = dict(('p%d' % p, percentile(values, p)) for p in (50, 95, 99))
+            stats.append(view)
+        return stats
+
+    def clear(self):
+        with _lock:
+            self.views.clear()
+            self.slow_queries.clear()
+
+
+def percentile(values, p):
+    'Nearest-rank percentile of a sorted list of values.'
+    if not values:
+        return None
+    index = max(int(round(p / 100.0 * len(values))) - 1, 0)
+    return values[min(index, len(values) - 1)]
+
+
+#: process-wide query log
+query_log = QueryLog()
+
+
+def current_queries():
+    '''eXist calls recorded so far for the instrumented view being
+    handled in this thread, or None.'''
+    return getattr(_local, 'queries', None)
+
+
+def record_query(xquery, time_taken, size=None, hits=None, count=None):
+    '''Record an eXist call for the current request and the slow query
+    log; ``time_taken`` is in seconds.'''
+    query = {'xquery': xquery, 'time': time_taken * 1000, 'bytes': size,
+             'hits': hits, 'count': count}
+    queries = current_queries()
+    if queries is not None:
+        queries.append(query)
+    query_log.add_query(query, getattr(_local, 'view', None))
+    return query
+
+
+def _xquery_called(sender, name=None, time_taken=0, return_value=None,
+                   kwargs=None, **kw):
+    # record every eXist REST query made through eulexistdb
+    kwargs = kwargs or {}
+    xquery = kwargs.get('xquery')
+    if xquery is None and kwargs.get('release') is not None:
+        xquery = '(release result %s)' % kwargs['release']
+    size = hits = count = None
+    content = getattr(return_value, 'content', None)
+    if content is not None:
+        size = len(content)
+        head = content[:1024]
+        match = _hits_re.search(head)
+        if match:
+            hits = int(match.group(1))
+        match = _count_re.search(head)
+        if match:
+            count = int(match.group(1))
+    record_query(xquery, time_taken, size, hits, count)
+
+if db.xquery_called is not None:
+    db.xquery_called.connect(_xquery_called, dispatch_uid='oxex-instrumentation')
+
+
+def server_timing(queries, total_time):
+    'Server-Timing header value for the eXist calls and total view time (ms).'
+    return 'exist;dur=%.1f;desc="%d eXist queries", total;dur=%.1f' % \
+        (sum(q['time'] for q in queries), len(queries), total_time)
+
+
+def instrument_view(view):
+    '''View decorator that records the eXist calls made while handling a
+    request, adds a ``Server-Timing`` header with eXist and total time,
+    and adds the request to the per-view statistics in :data:`query_log`.'''
+    @wraps(view)
+    def _instrumented(request, *args, **kwargs):
+        _local.queries = []
+        _local.view = view.__name__
+        start = time.time()
+        try:
+            response = view(request, *args, **kwargs)
+        finally:
+            total_time = (time.time() - start) * 1000
+            queries = _local.queries
+            _local.queries = _local.view = None
+            query_log.add_request(view.__name__, total_time, queries)
+        response['Server-Timing'] = server_timing(queries, total_time)
+        request.exist_queries = queries
+        return response
+    return _instrumented
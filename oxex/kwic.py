@@ -0,0 +1,75 @@
+import logging
+
+from django.conf import settings
+from lxml import etree
+
+from eulexistdb.db import ExistDBException
+from eulexistdb.query import escape_string
+
+from oxex.existdb import get_exist_db
+from oxex.stylesheets import stylesheets
+
+logger = logging.getLogger(__name__)
+
+KWIC_XQUERY = '''import module namespace kwic="http://exist-db.org/xquery/kwic";
+declare namespace tei="http://www.tei-c.org/ns/1.0";
+<results>{
+for $doc in collection("%(collection)s")/tei:TEI[@xml:id = (%(ids)s)]
+return <doc id="{$doc/@xml:id}">{
+  for $hit in $doc//tei:text[ft:query(., "%(keyword)s")]
+  return subsequence(kwic:summarize($hit, <config width="%(width)d"/>), 1, %(max)d)
+}</doc>
+}</results>'''
+
+
+def kwic_xquery(ids, keyword):
+    '''XQuery to generate keyword-in-context summaries for a list of
+    documents in a single query.'''
+    return KWIC_XQUERY % {
+        'collection': '/db/%s' % settings.EXISTDB_ROOT_COLLECTION.strip('/'),
+        'ids': ', '.join('"%s"' % escape_string(i) for i in ids),
+        'keyword': escape_string(keyword),
+        'width': getattr(settings, 'OXEX_KWIC_WIDTH', 40),
+        'max': getattr(settings, 'OXEX_KWIC_SNIPPETS', 3),
+    }
+
+
+def format_snippets(results):
+    '''Run ``kwic-snippets.xsl`` once over the summaries for a page of
+    results; returns a dictionary of HTML snippets keyed on document id.'''
+    output = stylesheets.get('kwic-snippets')(results)
+    snippets = {}
+    for div in output.getroot().iterchildren():
+        doc_id = div.get('id')[len('kwic-'):]
+        snippets[doc_id] = etree.tostring(div, encoding=unicode, method='html')
+    return snippets
+
+
+def kwic_snippets(ids, keyword):
+    '''Keyword-in-context snippets for every document on a page of search
+    results, from one eXist query and one XSLT transform.  Returns a
+    dictionary of HTML snippets keyed on document id; documents with no
+    matches in the text are not included.  If the query fails, the error
+    is logged and no snippets are returned, since they are not essential
+    to the search results.'''
+    ids = list(ids)
+    if not ids or not keyword:
+        return {}
+    try:
+        result = get_exist_db().query(kwic_xquery(ids, keyword), how_many=1)
+    except ExistDBException:
+        logger.exception('Error retrieving keyword in context snippets')
+        return {}
+    if not result.results:
+        return {}
+    return format_snippets(etree.ElementTree(result.results[0]))
+
+
+def add_kwic_snippets(docs, keyword):
+    '''Set a ``kwic`` attribute with the keyword-in-context snippet on each
+    document in a page of search results; returns the documents as a list.'''
+    docs = list(docs)
+    snippets = kwic_snippets([doc.id for doc in docs], keyword)
+    for doc in docs:
+        doc.kwic = snippets.get(doc.id)
+    return docs
@@ -0,0 +1,234 @@
+import json
+import os
+import random
+import resource
+import shutil
+import tempfile
+import time
+from optparse import make_option
+from urllib import urlencode
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.core.urlresolvers import reverse
+from django.test.client import Client
+from django.test.utils import override_settings, setup_test_environment, teardown_test_environment
+from lxml import etree
+
+from eulexistdb.db import ExistDBException
+
+from oxex.cache import invalidate_collection
+from oxex.existdb import get_exist_db
+from oxex.fulltext import fulltext_index
+from oxex.instrumentation import percentile
+from oxex.models import DocTitle
+from oxex.search import result_sets
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'fixtures')
+FIXTURES = ['Allen_Bio.xml', 'allen.xml', 'Allen11-CandlerLetter.xml']
+INDEX_CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            '..', '..', '..', 'exist_index.xconf')
+
+XML_ID = '{http://www.w3.org/XML/1998/namespace}id'
+
+# the benchmark runs with its own cache, so starting from empty caches does
+# not invalidate the content cached by a deployment sharing the settings
+BENCHMARK_CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'oxex-benchmark',
+    }
+}
+
+# search form parameters for each of the timed searches
+SEARCHES = [
+    ('search_keyword', {'keyword': 'missionary'}),
+    ('search_title', {'title': 'letter'}),
+    ('search_author', {'author': 'Candler'}),
+    ('search_date', {'date': '1892'}),
+    ('search_wildcard', {'keyword': 'miss*'}),
+]
+
+
+def synthesize_corpus(count):
+    '''Generate ``count`` TEI documents by copying the test fixtures with
+    new, unique ``xml:id`` values; yields tuples of document id and
+    serialized XML.'''
+    fixtures = [etree.parse(os.path.join(FIXTURE_DIR, f)) for f in FIXTURES]
+    for i in xrange(count):
+        tree = fixtures[i % len(fixtures)]
+        root = tree.getroot()
+        original_id = root.get(XML_ID)
+        doc_id = '%s.bench%05d' % (original_id, i)
+        root.set(XML_ID, doc_id)
+        try:
+            yield doc_id, etree.tostring(tree, encoding='UTF-8', xml_declaration=True)
+        finally:
+            root.set(XML_ID, original_id)
+
+
+def peak_rss():
+    'Peak resident set size of this process, in kilobytes.'
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class Command(BaseCommand):
+    help = '''Benchmark browse, search and document display.
+
+Loads a synthetic corpus generated from the TEI test fixtures into a
+separate eXist collection, times requests to the docs, searchbox and
+doc_display views through the Django test client, and reports 50th, 95th
+and 99th percentile latency (in milliseconds) and peak memory as JSON.
+
+Requests use a separate, process-local cache, so the configured cache
+(and any deployment using it) is not touched.  With the local search
+backend, the corpus is also written to a temporary TEI directory for the
+full-text index; with --no-load, the local backend searches the configured
+OXEX_TEI_DIRECTORY, which the report includes.'''
+
+    option_list = BaseCommand.option_list + (
+        make_option('--documents', '-n', dest='documents', type='int', default=1000,
+            help='Number of documents in the synthetic corpus (default: %default)'),
+        make_option('--requests', '-r', dest='requests', type='int', default=50,
+            help='Number of timed requests per view or search (default: %default)'),
+        make_option('--collection', dest='collection', default=None,
+            help='eXist collection for the synthetic corpus ' +
+                 '(default: EXISTDB_ROOT_COLLECTION with _benchmark appended)'),
+        make_option('--no-load', dest='load', action='store_false', default=True,
+            help='Benchmark against a corpus already loaded in the collection'),
+        make_option('--keep', dest='keep', action='store_true', default=False,
+            help='Do not remove the benchmark collection (or TEI directory) afterwards'),
+        make_option('--seed', dest='seed', type='int', default=0,
+            help='Random seed for the pages and documents requested (default: %default)'),
+        make_option('--output', '-o', dest='output', default=None,
+            help='Write the JSON report to a file instead of standard output'),
+    )
+
+    def handle(self, *args, **options):
+        if not getattr(settings, 'EXISTDB_ROOT_COLLECTION', None):
+            raise CommandError('EXISTDB_ROOT_COLLECTION setting is missing')
+        collection = options['collection'] or \
+            '%s_benchmark' % settings.EXISTDB_ROOT_COLLECTION.rstrip('/')
+        if collection.strip('/') == settings.EXISTDB_ROOT_COLLECTION.strip('/') \
+                and options['load']:
+            raise CommandError('Refusing to load a benchmark corpus into %s; ' % collection +
+                               'use --no-load to benchmark the configured collection')
+        self.verbosity = int(options['verbosity'])
+        random.seed(options['seed'])
+
+        db = get_exist_db()
+        report = {'documents': options['documents'], 'requests': options['requests'],
+                  'collection': collection, 'views': {},
+                  'search_backend': 'local' if fulltext_index.enabled else 'exist'}
+        tei_directory = getattr(settings, 'OXEX_TEI_DIRECTORY', None)
+        if options['load'] and fulltext_index.enabled:
+            # the local backend indexes files, not the eXist collection
+            tei_directory = tempfile.mkdtemp(prefix='oxex-benchmark-')
+        if fulltext_index.enabled:
+            report['tei_directory'] = tei_directory
+        try:
+            if options['load']:
+                report['load_seconds'] = self.load_corpus(db, collection, options['documents'],
+                    tei_directory if fulltext_index.enabled else None)
+
+            setup_test_environment()
+            try:
+                with override_settings(EXISTDB_ROOT_COLLECTION=collection,
+                                       OXEX_TEI_DIRECTORY=tei_directory,
+                                       CACHES=BENCHMARK_CACHES):
+                    report['views'] = self.run_benchmarks(options['requests'])
+            finally:
+                teardown_test_environment()
+        finally:
+            if options['load'] and not options['keep']:
+                try:
+                    db.removeCollection(collection)
+                    db.removeCollectionIndex(collection)
+                except ExistDBException as err:
+                    self.stderr.write('Error removing collection %s: %s' % (collection, err))
+                if fulltext_index.enabled:
+                    shutil.rmtree(tei_directory, ignore_errors=True)
+
+        report['peak_rss_kb'] = peak_rss()
+        output = json.dumps(report, indent=2, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w') as outfile:
+                outfile.write(output)
+        else:
+            self.stdout.write(output)
+
+    def load_corpus(self, db, collection, count, directory=None):
+        '''Load the synthetic corpus into eXist, and write it to a TEI
+        directory if given; returns the time taken in seconds.'''
+        start = time.time()
+        db.createCollection(collection, overwrite=True)
+        with open(INDEX_CONFIG) as config:
+            db.loadCollectionIndex(collection, config)
+        for doc_id, xml in synthesize_corpus(count):
+            db.load(xml, '%s/%s.xml' % (collection, doc_id))
+            if directory is not None:
+                with open(os.path.join(directory, '%s.xml' % doc_id), 'w') as tei:
+                    tei.write(xml)
+        db.reindexCollection(collection)
+        elapsed = time.time() - start
+        if self.verbosity > 1:
+            self.stderr.write('Loaded %d documents in %.1fs' % (count, elapsed))
+        return elapsed
+
+    def run_benchmarks(self, requests):
+        '''Time requests to each view; returns latency percentiles keyed
+        on view or search name.'''
+        # start from empty (benchmark) caches, so cold requests are
+        # included in the timings
+        invalidate_collection()
+        result_sets.clear()
+        client = Client()
+
+        # find the number of browse pages
+        response = client.get(reverse('docs'))
+        if response.status_code != 200:
+            raise CommandError('Browse returned %s' % response.status_code)
+        paginator = response.context['docs_paginated'].paginator
+        # documents to display are sampled from the whole collection, so
+        # repeated requests are not all served from the cache
+        docs = DocTitle.objects.only('id')
+        docs.default_chunk_size = 1000
+        doc_ids = [doc.id for doc in docs]
+        if not doc_ids:
+            raise CommandError('No documents found to benchmark')
+
+        urls = {
+            'docs': lambda: '%s?page=%d' % (reverse('docs'),
+                                            random.randint(1, paginator.num_pages)),
+            'doc_display': lambda: reverse('doc_display', args=[random.choice(doc_ids)]),
+        }
+        for name, params in SEARCHES:
+            query = urlencode([(field, value.encode('utf-8'))
+                               for field, value in sorted(params.iteritems())])
+            urls[name] = lambda query=query: '%s?%s&page=%d' % \
+                (reverse('search'), query, random.randint(1, 3))
+
+        results = {}
+        for name in sorted(urls):
+            timings = []
+            errors = 0
+            for i in xrange(requests):
+                start = time.time()
+                response = client.get(urls[name]())
+                timings.append((time.time() - start) * 1000)
+                if response.status_code != 200:
+                    errors += 1
+            timings.sort()
+            results[name] = {
+                'requests': requests,
+                'errors': errors,
+                'mean_ms': sum(timings) / len(timings) if timings else None,
+                'p50_ms': percentile(timings, 50),
+                'p95_ms': percentile(timings, 95),
+                'p99_ms': percentile(timings, 99),
+            }
+            if self.verbosity > 1:
+                self.stderr.write('%s: p50 %.1fms, p95 %.1fms' %
+                                  (name, results[name]['p50_ms'] or 0, results[name]['p95_ms'] or 0))
+        return results
@@ -0,0 +1,217 @@
+import json
+import math
+import multiprocessing
+import os
+import re
+import shutil
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.core.urlresolvers import reverse, resolve
+from django.test.client import RequestFactory
+
+from oxex.cache import collection_generation
+from oxex.existdb import reset_exist_db
+from oxex.models import DocTitle
+
+MANIFEST = 'manifest.json'
+
+# number of documents on each browse page, as in the docs view
+BROWSE_PAGE_SIZE = 26
+
+# pagination links on the browse pages (e.g. ?page=2), which are exported
+# as browse/page-N.html
+_page_link_re = re.compile(r'href="\?page=(\d+)"')
+
+_output_dir = None
+
+
+def _init_worker(output_dir):
+    global _output_dir
+    _output_dir = output_dir
+    # open new eXist connections in each worker process
+    reset_exist_db()
+
+
+def static_page_links(content):
+    'Point browse pagination links at the exported page-N.html files.'
+    return _page_link_re.sub(r'href="page-\1.html"', content)
+
+
+def _render(url, filename, rewrite=None):
+    # render a url with its view and write the response content to a file
+    # under the output directory, optionally rewritten (e.g. to fix links
+    # for the static site); returns the relative path
+    path = url.split('?')[0]
+    request = RequestFactory().get(url)
+    match = resolve(path)
+    response = match.func(request, *match.args, **match.kwargs)
+    if response.status_code != 200:
+        raise Exception('%s returned %s' % (url, response.status_code))
+    relpath = filename.lstrip('/')
+    fullpath = os.path.join(_output_dir, relpath)
+    if not os.path.isdir(os.path.dirname(fullpath)):
+        os.makedirs(os.path.dirname(fullpath))
+    with open(fullpath, 'wb') as outfile:
+        if response.streaming:
+            for chunk in response.streaming_content:
+                outfile.write(chunk)
+        elif rewrite is not None:
+            outfile.write(rewrite(response.content))
+        else:
+            outfile.write(response.content)
+    return relpath
+
+
+def export_document(doc_id):
+    '''Render the display page and TEI download for a single document.
+    Returns the document id, the files written, the time taken in seconds
+    and an error message, if any.'''
+    start = time.time()
+    files = []
+    try:
+        display_url = reverse('doc_display', args=[doc_id])
+        files.append(_render(display_url, os.path.join(display_url, 'index.html')))
+        download_url = reverse('doc_down', args=[doc_id])
+        files.append(_render(download_url, download_url))
+        error = None
+    except Exception as err:
+        error = '%s: %s' % (err.__class__.__name__, err)
+    return doc_id, files, time.time() - start, error
+
+
+def export_browse_page(number):
+    '''Render a single browse page; returns the page number, the files
+    written, the time taken in seconds and an error message, if any.'''
+    start = time.time()
+    files = []
+    try:
+        browse_url = reverse('docs')
+        if number == 1:
+            files.append(_render(browse_url, os.path.join(browse_url, 'index.html'),
+                                 static_page_links))
+        files.append(_render('%s?page=%d' % (browse_url, number),
+                             os.path.join(browse_url, 'page-%d.html' % number),
+                             static_page_links))
+        error = None
+    except Exception as err:
+        error = '%s: %s' % (err.__class__.__name__, err)
+    return number, files, time.time() - start, error
+
+
+class Command(BaseCommand):
+    help = '''Export the site as static files for the front-end web server.
+
+Renders the display page (doc_id/index.html) and TEI download
+(doc_id/download) for every document, and the browse pages
+(browse/index.html and browse/page-N.html, for browse/?page=N), into an
+output directory, using a pool of worker processes.  Documents whose
+content hash has not changed since the last export are skipped; a
+manifest.json with the hashes, files and timings is written to the output
+directory.'''
+
+    args = '<output directory>'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--processes', '-p', dest='processes', type='int',
+            default=multiprocessing.cpu_count(),
+            help='Number of worker processes (default: number of CPUs, %default)'),
+        make_option('--force', '-f', dest='force', action='store_true', default=False,
+            help='Render all documents, even if they have not changed; ' +
+                 'files for removed documents are still cleaned up'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Please specify an output directory')
+        output_dir = os.path.abspath(args[0])
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+        verbosity = int(options['verbosity'])
+        start = time.time()
+
+        previous_manifest = {}
+        manifest_path = os.path.join(output_dir, MANIFEST)
+        # the previous manifest is read even when forced, so that files for
+        # documents removed since the last export are cleaned up
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as manifest_file:
+                previous_manifest = json.load(manifest_file)
+        previous = previous_manifest.get('documents', {})
+
+        docs = DocTitle.objects.only('id', 'hash')
+        docs.default_chunk_size = 1000
+        hashes = dict((doc.id, doc.hash) for doc in docs)
+
+        documents = {}
+        changed = []
+        for doc_id, doc_hash in hashes.iteritems():
+            entry = previous.get(doc_id)
+            if entry and not options['force'] and entry.get('hash') == doc_hash and \
+                    not entry.get('error') and \
+                    all(os.path.exists(os.path.join(output_dir, f)) for f in entry['files']):
+                documents[doc_id] = entry
+            else:
+                changed.append(doc_id)
+
+        # remove the exported files for documents no longer in the collection
+        for doc_id in set(previous) - set(hashes):
+            for f in previous[doc_id].get('files', []):
+                directory = os.path.dirname(os.path.join(output_dir, f))
+                if os.path.isdir(directory):
+                    shutil.rmtree(directory)
+
+        num_pages = max(int(math.ceil(len(hashes) / float(BROWSE_PAGE_SIZE))), 1)
+        failed = 0
+        pool = multiprocessing.Pool(options['processes'], _init_worker, (output_dir,))
+        try:
+            results = pool.imap_unordered(export_document, changed)
+            for doc_id, files, seconds, error in results:
+                documents[doc_id] = {'hash': hashes[doc_id], 'files': files,
+                                     'seconds': round(seconds, 3)}
+                if error:
+                    documents[doc_id]['error'] = error
+                    failed += 1
+                    self.stderr.write('Error exporting %s: %s' % (doc_id, error))
+                elif verbosity > 1:
+                    self.stdout.write('Exported %s in %.2fs' % (doc_id, seconds))
+
+            browse = previous_manifest.get('browse_pages', {})
+            # the browse pages list every document, so they are rendered
+            # again if anything has changed
+            if changed or set(previous) != set(hashes) or not browse or options['force']:
+                for number, entry in browse.iteritems():
+                    if int(number) > num_pages:
+                        for f in entry.get('files', []):
+                            if os.path.exists(os.path.join(output_dir, f)):
+                                os.remove(os.path.join(output_dir, f))
+                browse = {}
+                for number, files, seconds, error in pool.imap(export_browse_page,
+                                                               range(1, num_pages + 1)):
+                    browse[str(number)] = {'files': files, 'seconds': round(seconds, 3)}
+                    if error:
+                        browse[str(number)]['error'] = error
+                        failed += 1
+                        self.stderr.write('Error exporting browse page %d: %s' % (number, error))
+        finally:
+            pool.close()
+            pool.join()
+
+        elapsed = time.time() - start
+        manifest = {
+            'exported': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'generation': collection_generation(),
+            'seconds': round(elapsed, 3),
+            'rendered': len(changed),
+            'skipped': len(hashes) - len(changed),
+            'failed': failed,
+            'browse_pages': browse,
+            'documents': documents,
+        }
+        with open(manifest_path, 'w') as manifest_file:
+            json.dump(manifest, manifest_file, indent=2, sort_keys=True)
+
+        if verbosity:
+            self.stdout.write('Rendered %d documents (%d unchanged, %d errors) in %.1fs' %
+                              (len(changed), len(hashes) - len(changed), failed, elapsed))
@@ -0,0 +1,73 @@
+import json
+import os
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from oxex.cache import check_shared_cache
+from oxex.ingest import load_directory
+
+
+class Command(BaseCommand):
+    help = '''Load a directory of TEI files into eXist.
+
+Uploads every .xml file in the directory (and its subdirectories) to the
+configured eXist collection with a bounded pool of threads, installs the
+exist_index.xconf index configuration and reindexes the collection once
+at the end.  Reports documents loaded, documents per second, failures and
+total bytes.
+
+A manifest of the files loaded, with their content hashes, is kept in the
+directory (.oxex-ingest.json).  Once there is a manifest, later loads
+only upload new and changed files and remove documents for deleted files,
+without a full reindex.'''
+
+    args = '<directory>'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--threads', '-t', dest='threads', type='int', default=4,
+            help='Number of concurrent uploads (default: %default)'),
+        make_option('--collection', '-c', dest='collection', default=None,
+            help='eXist collection to load into (default: EXISTDB_ROOT_COLLECTION)'),
+        make_option('--no-reindex', dest='reindex', action='store_false', default=True,
+            help='Leave the index configuration alone and do not reindex; ' +
+                 'documents are indexed as they are stored'),
+        make_option('--manifest', '-m', dest='manifest', default=None,
+            help='Path to the ingest manifest (default: .oxex-ingest.json in the directory)'),
+        make_option('--full', dest='full', action='store_true', default=False,
+            help='Upload every file, even if it has not changed since the last load'),
+        make_option('--json', dest='json', action='store_true', default=False,
+            help='Report as JSON'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1 or not os.path.isdir(args[0]):
+            raise CommandError('Please specify a directory of TEI files')
+        collection = options['collection'] or getattr(settings, 'EXISTDB_ROOT_COLLECTION', None)
+        if not collection:
+            raise CommandError('EXISTDB_ROOT_COLLECTION setting is missing')
+        if options['threads'] < 1:
+            raise CommandError('--threads must be at least 1')
+        if not check_shared_cache():
+            self.stderr.write('Warning: the cache is not shared with the web workers, ' +
+                              'which will not see the new collection generation')
+
+        report = load_directory(args[0], collection, threads=options['threads'],
+                                reindex=options['reindex'], manifest=options['manifest'],
+                                full=options['full'])
+
+        if options['json']:
+            self.stdout.write(json.dumps(report.as_dict(), indent=2, sort_keys=True))
+        else:
+            self.stdout.write('Loaded %d documents (%d bytes) into %s in %.1fs, %.1f documents/sec' %
+                              (report.documents, report.bytes, collection, report.seconds,
+                               report.docs_per_second))
+            self.stdout.write('%d unchanged, %d removed; collection generation %s' %
+                              (report.unchanged, report.removed, report.generation))
+            if report.failures:
+                self.stdout.write('%d failures:' % len(report.failures))
+                for failure in report.failures:
+                    self.stdout.write('  %(path)s: %(error)s' % failure)
+        if report.failures:
+            raise CommandError('%d documents could not be loaded' % len(report.failures))
@@ -1,12 +1,13 @@
 from django.utils.safestring import mark_safe
 
-from eulexistdb.manager import Manager
 from eulexistdb.models import XmlModel
 from eulxml.xmlmap.core import XmlObject
 from eulxml.xmlmap.dc import DublinCore
 from eulxml.xmlmap.fields import StringField, NodeField, StringListField, NodeListField
 from eulxml.xmlmap.teimap import Tei, TeiDiv, TEI_NAMESPACE
 
+from oxex.existdb import Manager
+
 class Bibliography(XmlObject):
     ROOT_NAMESPACES = {'tei' : TEI_NAMESPACE}
     # TODO: handle repeating elements
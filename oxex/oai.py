@@ -0,0 +1,217 @@
+from array import array
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timedelta
+import hashlib
+import logging
+import re
+import threading
+
+from django.conf import settings
+from django.utils.text import slugify
+
+from django_oaipmh.views import OAIProvider
+
+from oxex.cache import collection_generation
+from oxex.dublincore import dc_records
+from oxex.models import DocTitle
+
+logger = logging.getLogger(__name__)
+
+#: OAI sets, as (setSpec, setName, DocTitle field); documents are in a
+#: subset for each value of the field, e.g. ``subject:china``
+SET_FIELDS = (
+    ('subject', 'Subject', 'lcsh_subjects'),
+    ('geography', 'Geographic coverage', 'geo_coverage'),
+)
+
+
+# eXist last-modified time for a document, as an xs:dateTime string with
+# the server timezone (the last_modified field drops the timezone)
+LAST_MODIFIED_XPATH = 'string(xmldb:last-modified(util:collection-name(%(xq_var)s), ' + \
+                      'util:document-name(%(xq_var)s)))'
+
+_datetime_re = re.compile(r'^(\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d)(\.\d+)?' +
+                          r'(Z|([+-])(\d\d):(\d\d))?$')
+
+
+def utc_datestamp(value):
+    '''Parse an xs:dateTime string, with or without fractional seconds and
+    timezone, as a naive UTC datetime (OAI datestamps are UTC); values
+    without a timezone are assumed to be UTC.  Fractional seconds are
+    dropped, since datestamps have a granularity of seconds.'''
+    match = _datetime_re.match(value.strip())
+    if match is None:
+        raise ValueError('Invalid dateTime %r' % value)
+    date = datetime.strptime(match.group(1), '%Y-%m-%dT%H:%M:%S')
+    if match.group(4):
+        offset = timedelta(hours=int(match.group(5)), minutes=int(match.group(6)))
+        date = date - offset if match.group(4) == '+' else date + offset
+    return date
+
+
+def set_spec(parent, value):
+    '''OAI setSpec for a value of a set field, under the parent set.
+    setSpecs are limited to unreserved URI characters, so the value is
+    slugified; values with nothing left are identified by a hash.'''
+    slug = slugify(value) or hashlib.md5(value.encode('utf-8')).hexdigest()[:12]
+    return '%s:%s' % (parent, slug)
+
+
+class OAIRecord(object):
+    'Identifier, datestamp and sets for a document available through OAI-PMH.'
+    __slots__ = ('id', 'last_modified', 'sets')
+
+    def __init__(self, id, last_modified, sets=()):
+        self.id = id
+        self.last_modified = last_modified
+        self.sets = sets
+
+    def __repr__(self):
+        return '<OAIRecord %s>' % self.id
+
+
+class RecordIndex(object):
+    '''In-process index of :class:`OAIRecord` for every document in the
+    collection, loaded in a single eXist query and reloaded the first time
+    it is used after the collection generation changes (i.e., after each
+    ingest).  Records can be looked up by document id, or by a range of
+    datestamps with a binary search over the records sorted by
+    datestamp, without an eXist query.
+
+    Datestamps are the eXist last-modified times converted to UTC.  Set
+    membership (see :data:`SET_FIELDS`) is indexed at the same time:
+    each set has a sorted array of the positions of its records in
+    datestamp order, so a set, or a range of datestamps within a set, is
+    found with a binary search rather than by checking every record.'''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # generation, records in datestamp order, records by id, sorted
+        # datestamps, set names and record positions by setSpec
+        self._state = (None, (), {}, (), {})
+
+    def load(self):
+        generation = collection_generation()
+        fields = [field for spec, name, field in SET_FIELDS]
+        docs = DocTitle.objects.only('id', *fields).only_raw(modified=LAST_MODIFIED_XPATH)
+        docs.default_chunk_size = 1000
+        # datestamps are compared with OAI from and until dates, in UTC
+        docs = sorted(((utc_datestamp(d.modified), d) for d in docs),
+                      key=lambda (modified, d): (modified, d.id))
+
+        records = []
+        sets = {}
+        for position, (modified, doc) in enumerate(docs):
+            specs = []
+            for parent, parent_name, field in SET_FIELDS:
+                values = getattr(doc, field)
+                if isinstance(values, basestring):
+                    values = [values]
+                for value in values or []:
+                    value = value.strip()
+                    if not value:
+                        continue
+                    spec = set_spec(parent, value)
+                    if spec not in specs:
+                        specs.append(spec)
+                        # values that slugify the same share a set, named
+                        # for the first value seen
+                        sets.setdefault(spec, (value, array('I')))[1].append(position)
+                if any(s.startswith(parent + ':') for s in specs):
+                    sets.setdefault(parent, (parent_name, array('I')))[1].append(position)
+            records.append(OAIRecord(doc.id, modified, tuple(specs)))
+        records = tuple(records)
+
+        with self._lock:
+            self._state = (generation, records, dict((r.id, r) for r in records),
+                           tuple(r.last_modified for r in records), sets)
+        logger.debug('loaded OAI record index of %d documents in %d sets for generation %s',
+                     len(records), len(sets), generation)
+        return records
+
+    def _current(self):
+        if self._state[0] != collection_generation():
+            self.load()
+        return self._state
+
+    def all(self):
+        'All records, in datestamp order.'
+        return self._current()[1]
+
+    def get(self, doc_id):
+        'Record for a single document by id, or None.'
+        return self._current()[2].get(doc_id)
+
+    def between(self, from_date=None, until_date=None, set_spec=None):
+        '''Records with datestamps in a range (inclusive; either end may be
+        None), in datestamp order; limited to the records in a set if
+        ``set_spec`` is given.'''
+        generation, records, by_id, datestamps, sets = self._current()
+        start = bisect_left(datestamps, from_date) if from_date is not None else 0
+        end = bisect_right(datestamps, until_date) if until_date is not None else len(records)
+        if set_spec is None:
+            return records[start:end]
+        if set_spec not in sets:
+            return ()
+        positions = sets[set_spec][1]
+        return tuple(records[p] for p in
+                     positions[bisect_left(positions, start):bisect_left(positions, end)])
+
+    def sets(self):
+        'All sets, as (setSpec, setName) tuples ordered by setSpec.'
+        sets = self._current()[4]
+        return [(spec, sets[spec][0]) for spec in sorted(sets)]
+
+
+#: process-wide OAI record index
+record_index = RecordIndex()
+
+
+class OxExOAIProvider(OAIProvider):
+    '''OAI-PMH provider for the Oxford Experience documents.  Resumption
+    tokens are tied to the collection generation, so a harvest restarts if
+    the collection changes part way through.  Single records, date ranges
+    and sets are looked up in the :class:`RecordIndex`, and ``oai_dc``
+    metadata comes from the Dublin Core record store.'''
+
+    @property
+    def batch_size(self):
+        return getattr(settings, 'OXEX_OAI_BATCH_SIZE', 100)
+
+    @property
+    def repository_identifier(self):
+        return getattr(settings, 'OXEX_OAI_REPOSITORY_ID', 'beck.library.emory.edu')
+
+    def items(self):
+        # in datestamp order, so batches are stable across requests
+        return record_index.all()
+
+    def filtered_items(self, from_date=None, until_date=None, set_spec=None):
+        return record_index.between(from_date, until_date, set_spec)
+
+    def last_modified(self, obj):
+        return obj.last_modified
+
+    def sets(self, obj):
+        return obj.sets
+
+    def set_list(self):
+        return record_index.sets()
+
+    def oai_identifier(self, obj):
+        return 'oai:%s:%s' % (self.repository_identifier, obj.id)
+
+    def item_by_id(self, identifier):
+        prefix = 'oai:%s:' % self.repository_identifier
+        if not identifier.startswith(prefix):
+            return None
+        return record_index.get(identifier[len(prefix):])
+
+    def version(self):
+        return collection_generation()
+
+    def metadata_records(self, items, prefix):
+        # oai_dc records are pre-serialized in the Dublin Core record
+        # store; records missing from the store are built in one query
+        records = dc_records.get_many([i.id for i in items])
+        return [records[i.id]['xml'] if i.id in records else '' for i in items]
@@ -0,0 +1,30 @@
+from django.core.paginator import Paginator, InvalidPage
+
+
+class ResultPaginator(Paginator):
+    """Paginator that delivers the last page of results when the requested
+    page is out of range."""
+
+    def page_or_last(self, number):
+        """Return the requested page; if the page number is invalid or
+        out of range, deliver the last page of results."""
+        try:
+            return self.page(number)
+        except InvalidPage:
+            return self.page(self.num_pages)
+
+
+class ExistPaginator(ResultPaginator):
+    """Paginator for :class:`eulexistdb.query.QuerySet` results.
+
+    The queryset is handed to eXist unevaluated: the total comes from the
+    eXist hit count and each page is retrieved as a slice of the result,
+    so only one page of records is pulled over HTTP per request.
+    """
+
+    def __init__(self, object_list, per_page, **kwargs):
+        # the query run to get the hit count also retrieves a chunk of
+        # results; keep that to a single record so that only the
+        # requested page is actually transferred
+        object_list.default_chunk_size = 1
+        super(ExistPaginator, self).__init__(object_list, per_page, **kwargs)
@@ -0,0 +1,159 @@
+from collections import OrderedDict
+import threading
+import time
+
+from django.conf import settings
+
+from oxex.cache import collection_generation, normalize_keyword
+from oxex.models import DocTitle
+
+SEARCH_FIELDS = ('keyword', 'title', 'author', 'date')
+
+
+def search_options(cleaned_data):
+    """Convert :class:`~oxex.forms.DocSearchForm` cleaned data into
+    eulexistdb filter arguments."""
+    search_opts = {}
+    if cleaned_data.get('title'):
+        search_opts['title__fulltext_terms'] = '%s' % cleaned_data['title']
+    if cleaned_data.get('author'):
+        search_opts['author__fulltext_terms'] = '%s' % cleaned_data['author']
+    if cleaned_data.get('keyword'):
+        search_opts['fulltext_terms'] = '%s' % cleaned_data['keyword']
+    if cleaned_data.get('date'):
+        search_opts['date__fulltext_terms'] = '%s' % cleaned_data['date']
+    return search_opts
+
+
+def too_many_clauses(error):
+    '''Check if an eXist error is a full-text query rejected because a
+    wildcard term expanded to more terms than the Lucene clause limit
+    (``maxClauseCount``).  Wildcard terms in eXist searches are expanded by
+    eXist, not against the local term dictionary, so this is the only cap
+    on them.'''
+    message = error.message() if callable(getattr(error, 'message', None)) else str(error)
+    return 'TooManyClauses' in message or 'maxClauseCount' in message
+
+
+def search_documents(cleaned_data):
+    """Build the unevaluated :class:`DocTitle` queryset for a search.
+
+    Nothing is retrieved from eXist here; paginate the result with
+    :class:`~oxex.paginator.ExistPaginator` so the total comes from the
+    eXist hit count and titles are only returned for the requested page.
+    Keyword context comes from :func:`~oxex.kwic.add_kwic_snippets`.
+    """
+    return DocTitle.objects.only('id', 'title', 'date', 'author') \
+                           .filter(**search_options(cleaned_data)).order_by('title')
+
+
+class ResultSetCache(object):
+    '''In-process LRU cache of search result sets, with a time-to-live.
+
+    Result sets are stored as the ordered tuple of matching document ids,
+    keyed on the canonicalized search form data and the collection
+    generation.  Configure with ``OXEX_SEARCH_CACHE_SIZE`` (maximum number
+    of result sets; 0 disables the cache) and ``OXEX_SEARCH_CACHE_TTL``
+    (seconds).'''
+
+    def __init__(self, max_size=None, ttl=None):
+        self._max_size = max_size
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._results = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def max_size(self):
+        if self._max_size is not None:
+            return self._max_size
+        return getattr(settings, 'OXEX_SEARCH_CACHE_SIZE', 100)
+
+    @property
+    def ttl(self):
+        if self._ttl is not None:
+            return self._ttl
+        return getattr(settings, 'OXEX_SEARCH_CACHE_TTL', 300)
+
+    @property
+    def enabled(self):
+        return self.max_size > 0
+
+    def key(self, cleaned_data):
+        'Canonical key for search form data: trimmed, case-folded terms.'
+        return (collection_generation(),) + \
+            tuple(normalize_keyword(cleaned_data.get(field)) for field in SEARCH_FIELDS)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._results.pop(key, None)
+            if entry is not None and entry[0] > time.time():
+                # re-insert as most recently used
+                self._results[key] = entry
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+    def set(self, key, ids):
+        with self._lock:
+            self._results.pop(key, None)
+            self._results[key] = (time.time() + self.ttl, tuple(ids))
+            while len(self._results) > self.max_size:
+                self._results.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._results.clear()
+
+    def stats(self):
+        return {'size': len(self._results), 'max_size': self.max_size,
+                'ttl': self.ttl, 'hits': self.hits, 'misses': self.misses}
+
+
+#: process-wide search result set cache
+result_sets = ResultSetCache()
+
+
+class CachedSearchResults(object):
+    '''Search results backed by an ordered list of matching document ids;
+    slicing fetches just the documents in the slice from eXist.  Can be
+    paginated with :class:`~oxex.paginator.ResultPaginator`.'''
+
+    def __init__(self, ids):
+        self.ids = ids
+
+    def count(self):
+        return len(self.ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def fetch(self, ids):
+        'Retrieve search result documents by id, in the order given.'
+        if not ids:
+            return []
+        docs = DocTitle.objects.only('id', 'title', 'date', 'author') \
+                               .filter(id__in=list(ids))
+        by_id = dict((doc.id, doc) for doc in docs)
+        return [by_id[i] for i in ids if i in by_id]
+
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            return self.fetch(self.ids[k])
+        return self.fetch([self.ids[k]])[0]
+
+
+def search_results(cleaned_data):
+    '''Run a search through the result set cache.  On a miss, only the
+    ordered ids of the matching documents are retrieved from eXist; each
+    page of results is then a single fetch of the documents on that page.'''
+    key = result_sets.key(cleaned_data)
+    ids = result_sets.get(key)
+    if ids is None:
+        docs = DocTitle.objects.only('id').filter(**search_options(cleaned_data)) \
+                               .order_by('title')
+        docs.default_chunk_size = 1000
+        ids = tuple(doc.id for doc in docs)
+        result_sets.set(key, ids)
+    return CachedSearchResults(ids)
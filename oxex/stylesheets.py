@@ -0,0 +1,88 @@
+import logging
+import os
+import threading
+
+from eulxml.xmlmap import load_xslt
+
+logger = logging.getLogger(__name__)
+
+XSLT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'xslt')
+
+# stylesheets used to render documents and search results
+DEFAULT_STYLESHEETS = ['form', 'article', 'footnotes', 'kwic', 'kwic-snippets',
+                       'exist-search', 'oxexp-dc']
+
+
+class StylesheetRegistry(object):
+    """Registry of compiled XSLT stylesheets from ``oxex/xslt``.
+
+    Each stylesheet is parsed and compiled the first time it is requested
+    and the compiled :class:`lxml.etree.XSLT` is reused on later requests;
+    it is recompiled if the file modification time changes.  Compiled
+    stylesheets are kept per thread, since lxml XSLT objects should not
+    be shared across threads.
+    """
+
+    def __init__(self, directory=XSLT_DIR):
+        self.directory = directory
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.compiles = 0
+        self.hits = 0
+
+    def path(self, name):
+        'Full path to a stylesheet, by name with or without ``.xsl``.'
+        if not name.endswith('.xsl'):
+            name = '%s.xsl' % name
+        return os.path.join(self.directory, name)
+
+    def version(self, name):
+        '''Version of a stylesheet, for keying content rendered with it:
+        the file modification time.'''
+        return os.path.getmtime(self.path(name))
+
+    def _cache(self):
+        if not hasattr(self._local, 'stylesheets'):
+            self._local.stylesheets = {}
+        return self._local.stylesheets
+
+    def get(self, name):
+        '''Get the compiled XSLT for a stylesheet, compiling it if it has
+        not been loaded yet or has changed on disk.'''
+        path = self.path(name)
+        mtime = os.path.getmtime(path)
+        cache = self._cache()
+        if path in cache and cache[path][0] == mtime:
+            with self._lock:
+                self.hits += 1
+            return cache[path][1]
+
+        xslt = load_xslt(filename=path)
+        cache[path] = (mtime, xslt)
+        with self._lock:
+            self.compiles += 1
+        logger.debug('compiled stylesheet %s', path)
+        return xslt
+
+    def preload(self, names=None):
+        'Compile the listed stylesheets (by default, all rendering stylesheets).'
+        for name in (names or DEFAULT_STYLESHEETS):
+            self.get(name)
+
+    def stats(self):
+        'Compile and cache hit counts, with the stylesheets loaded in this thread.'
+        return {
+            'compiles': self.compiles,
+            'hits': self.hits,
+            'loaded': sorted(os.path.basename(p) for p in self._cache()),
+        }
+
+
+#: process-wide stylesheet registry
+stylesheets = StylesheetRegistry()
+
+
+def transform(xmlobject, name, **params):
+    '''Run a registered stylesheet on an :class:`~eulxml.xmlmap.XmlObject`;
+    takes the same parameters as :meth:`~eulxml.xmlmap.XmlObject.xsl_transform`.'''
+    return xmlobject.xsl_transform(xsl=stylesheets.get(name), **params)
@@ -0,0 +1,134 @@
+import logging
+import sys
+import threading
+from operator import attrgetter
+
+from django.conf import settings
+
+from oxex.cache import collection_generation
+from oxex.models import DocTitle
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_FIELDS = ('id', 'title', 'date', 'author')
+
+
+class DocSummary(object):
+    '''Compact summary of the :class:`~oxex.models.DocTitle` fields used
+    to list documents; can be used in place of a ``DocTitle`` in the
+    browse and search result templates.'''
+    # kwic holds keyword-in-context snippets when listed in search results
+    __slots__ = SUMMARY_FIELDS + ('kwic',)
+
+    def __init__(self, id, title, date, author):
+        self.id = id
+        self.title = title
+        self.date = date
+        self.author = author
+        self.kwic = None
+
+    def __repr__(self):
+        return '<DocSummary %s>' % self.id
+
+
+class SummaryIndex(object):
+    '''In-process index of :class:`DocSummary` records for every document
+    in the collection, used to serve browse pages, sorting and counts
+    without an eXist query.  The index is reloaded the first time it is
+    used after the collection generation changes.'''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # generation, summaries in date order, summaries by id
+        self._state = (None, (), {})
+        self._sorted = {}
+
+    @property
+    def enabled(self):
+        return getattr(settings, 'OXEX_SUMMARY_INDEX', False)
+
+    def load(self):
+        '''Load summaries for all documents from eXist, in one query.'''
+        generation = collection_generation()
+        docs = DocTitle.objects.only(*SUMMARY_FIELDS).order_by('date')
+        docs.default_chunk_size = 1000
+        # share one copy of repeated values (authors, dates) across records
+        strings = {}
+        summaries = tuple(
+            DocSummary(*[strings.setdefault(v, v) for v in
+                         (d.id, d.title, d.date, d.author)])
+            for d in docs)
+        with self._lock:
+            self._state = (generation, summaries, dict((s.id, s) for s in summaries))
+            self._sorted = {}
+        logger.debug('loaded summary index of %d documents for generation %s',
+                     len(summaries), generation)
+        return summaries
+
+    def _current(self):
+        if self._state[0] != collection_generation():
+            self.load()
+        return self._state
+
+    def all(self):
+        'All document summaries, in date order.'
+        return self._current()[1]
+
+    def count(self):
+        return len(self.all())
+
+    def get(self, doc_id):
+        'Summary for a single document by id, or None.'
+        return self._current()[2].get(doc_id)
+
+    def ordered(self, field):
+        '''Document summaries sorted by one of the summary fields; use a
+        leading ``-`` for descending order.  Sort orders are computed once
+        per generation.'''
+        summaries = self.all()
+        if field == 'date':
+            return summaries
+        if field not in self._sorted:
+            name = field.lstrip('-')
+            if name not in SUMMARY_FIELDS:
+                raise ValueError('Cannot sort on %s' % name)
+            self._sorted[field] = tuple(sorted(summaries,
+                key=lambda s: (getattr(s, name) or '').lower(),
+                reverse=field.startswith('-')))
+        return self._sorted[field]
+
+    def memory_report(self):
+        '''Approximate memory used by the index, in bytes; shared values
+        are only counted once.'''
+        generation, summaries, by_id = self._state
+        seen = set()
+        size = sys.getsizeof(summaries) + sys.getsizeof(by_id)
+        for s in summaries:
+            size += sys.getsizeof(s)
+            for field in SUMMARY_FIELDS:
+                value = getattr(s, field)
+                if id(value) not in seen:
+                    seen.add(id(value))
+                    size += sys.getsizeof(value)
+        return {
+            'generation': generation,
+            'documents': len(summaries),
+            'bytes': size,
+            'bytes_per_document': size / len(summaries) if summaries else 0,
+        }
+
+
+#: process-wide document summary index
+summary_index = SummaryIndex()
+
+
+def warm_summary_index():
+    '''Load the summary index at worker start, if enabled.  Errors are
+    logged rather than raised, so an unavailable eXist does not prevent
+    the worker from starting; the index is loaded on first use instead.'''
+    if not summary_index.enabled:
+        return
+    try:
+        summary_index.load()
+    except Exception:
+        logger.exception('Could not load document summary index')
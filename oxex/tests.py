@@ -2,16 +2,51 @@
 Oxford Experience Test Cases
 """
 
+from array import array
+from datetime import datetime
+import os
 from os import path
+import json
+import re
+import shutil
+import tempfile
+import zlib
 
 from django.core.urlresolvers import reverse
 from django.test import TestCase
+from django.test.client import RequestFactory
+from django.http import HttpResponse
 from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.test.utils import override_settings
+from django.utils.timezone import get_fixed_timezone
 
 from eulxml import xmlmap
+from lxml import etree
 
 from oxex.models import DocTitle, Doc, Bibliography, SourceDescription, DocSearch
 from oxex.forms import DocSearchForm
+from oxex import cache as oxex_cache
+from oxex import ingest
+from oxex.cache import rendered_documents, collection_generation, invalidate_collection
+from oxex.download import accepted_encoding, compress_chunks, download_variant
+from oxex.summary import summary_index, DocSummary
+from oxex.facets import FacetIndex
+from oxex.search import ResultSetCache, too_many_clauses
+from eulexistdb.db import ExistDBException
+from oxex.existdb import get_exist_db, pool_stats
+from oxex.instrumentation import instrument_view, record_query, query_log, percentile
+from oxex.kwic import format_snippets, kwic_xquery
+from oxex.stylesheets import StylesheetRegistry, DEFAULT_STYLESHEETS, transform, stylesheets
+from oxex.management.commands.benchmark import synthesize_corpus
+from oxex.management.commands.export_static import static_page_links
+from oxex.ingest import tei_files, exist_path, load_directory, populate_dc_records
+from oxex.dublincore import dc_records, dc_record
+from oxex.oai import utc_datestamp
+from django_oaipmh.views import OAIProvider, parse_datestamp
+from oxex.fulltext import FulltextIndex, SearchQueryError, TooManyTermsError, tokenize, intersect, union, difference
 
 exist_fixture_path = path.join(path.dirname(path.abspath(__file__)), 'fixtures')
 exist_index_path = path.join(path.dirname(path.abspath(__file__)), '..', 'exist_index.xconf')
@@ -100,6 +135,22 @@ class OxExViewTestCase(TestCase):
         self.assertContains(response, reverse('doc_display', args=['oeAllenBio']),
             msg_prefix='includes link to "Biography of Young J. Allen"')
 
+    def test_docs_paginated(self):
+        docs_url = reverse('docs')
+        response = self.client.get(docs_url)
+        paginated = response.context['docs_paginated']
+        self.assertEqual(3, paginated.paginator.count,
+            'paginator count should come from eXist hit count')
+        self.assertEqual(3, len(list(paginated.object_list)))
+
+        # out of range page should deliver last page instead of an error
+        response = self.client.get(docs_url, {'page': 9999})
+        expected = 200
+        self.assertEqual(response.status_code, expected,
+                        'Expected %s but returned %s for %s' % \
+                        (expected, response.status_code, docs_url))
+        self.assertEqual(1, response.context['docs_paginated'].number)
+
     def test_doc_display(self):
         # doc_display should display the content of the document
         doc_display_url = reverse('doc_display', args=['allen.001'])
@@ -127,6 +178,30 @@ class OxExViewTestCase(TestCase):
                         'Expected %s but returned %s for %s' % \
                         (expected, response.status_code, doc_display_url))
 
+    def test_conditional_get(self):
+        for view in ['doc_display', 'doc_xml', 'doc_down']:
+            url = reverse(view, args=['allen.001'])
+            response = self.client.get(url)
+            self.assert_(response.has_header('ETag'), '%s should set an ETag' % view)
+            self.assert_(response.has_header('Last-Modified'),
+                '%s should set Last-Modified' % view)
+
+            # unchanged document should get a 304 not modified
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+            expected = 304
+            self.assertEqual(response.status_code, expected,
+                             'Expected %s but returned %s for %s with matching If-None-Match' % \
+                            (expected, response.status_code, url))
+            response = self.client.get(url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+            self.assertEqual(response.status_code, expected,
+                             'Expected %s but returned %s for %s with If-Modified-Since' % \
+                            (expected, response.status_code, url))
+
+    def test_server_timing(self):
+        response = self.client.get(reverse('doc_display', args=['allen.001']))
+        self.assert_(response.has_header('Server-Timing'))
+        self.assert_('exist;dur=' in response['Server-Timing'])
+
     def test_overview(self):
         overview_url = reverse('overview')
         response = self.client.get(overview_url)
@@ -163,6 +238,25 @@ class OxExViewTestCase(TestCase):
                         (expected, response.status_code, doc_down_url))
         self.assertEqual('application/tei+xml', response['Content-Type'])
         self.assertContains(response, '<TEI')
+        self.assert_([q for q in response.wsgi_request.exist_queries
+                      if q['xquery'].startswith('GET ')],
+            'streamed document request should be recorded')
+
+        # compressed download when the client accepts it
+        response = self.client.get(doc_down_url, HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual('gzip', response['Content-Encoding'])
+        content = zlib.decompress(b''.join(response.streaming_content), 16 + zlib.MAX_WBITS)
+        self.assert_('<TEI' in content)
+        # each content-encoding has its own etag
+        identity_etag = self.client.get(doc_down_url)['ETag']
+        self.assertNotEqual(identity_etag, response['ETag'])
+        response = self.client.get(doc_down_url, HTTP_ACCEPT_ENCODING='gzip',
+                                   HTTP_IF_NONE_MATCH=identity_etag)
+        self.assertEqual(200, response.status_code)
+
+        # pretty-printed download on request
+        response = self.client.get(doc_down_url, {'pretty': 1})
+        self.assertContains(response, '<TEI')
 
         # xml request for non-existent document should return 404
         doc_down_url = reverse('doc_xml', args=['nonexistent'])
@@ -244,3 +338,741 @@ class FullTextOxExViewsTest(TestCase):
         
 
  
+
+    def test_search_paginated(self):
+        search_url = reverse('search')
+        response = self.client.get(search_url, {'keyword': 'china', 'page': 9999})
+        expected = 200
+        self.assertEqual(response.status_code, expected,
+                        'Expected %s but returned %s for %s' % \
+                        (expected, response.status_code, search_url))
+        paginated = response.context['docs_paginated']
+        # out of range page should deliver last page of results
+        self.assertEqual(paginated.paginator.num_pages, paginated.number)
+        self.assert_(paginated.paginator.count >= 1,
+            'total should come from eXist hit count')
+        self.assert_(len(list(paginated.object_list)) <= 10,
+            'only the requested window of results should be retrieved')
+
+class StylesheetRegistryTest(TestCase):
+
+    def setUp(self):
+        self.registry = StylesheetRegistry()
+        self.doc = xmlmap.load_xmlobject_from_file(path.join(exist_fixture_path, 'allen.xml'), DocTitle)
+
+    def test_compile_once(self):
+        xslt = self.registry.get('form')
+        self.assertEqual(1, self.registry.compiles)
+        self.assert_(xslt is self.registry.get('form.xsl'),
+            'compiled stylesheet should be reused')
+        self.assertEqual(1, self.registry.compiles)
+        self.assertEqual(1, self.registry.hits)
+
+    def test_recompile_on_change(self):
+        self.registry.get('form')
+        # simulate a stylesheet that changed on disk since it was compiled
+        mtime, xslt = self.registry._cache()[self.registry.path('form')]
+        self.registry._cache()[self.registry.path('form')] = (mtime - 1, xslt)
+        self.registry.get('form')
+        self.assertEqual(2, self.registry.compiles)
+
+    def test_preload(self):
+        self.registry.preload()
+        self.assertEqual(len(DEFAULT_STYLESHEETS), self.registry.compiles)
+
+    def test_transform(self):
+        result = transform(self.doc, 'form')
+        self.assert_('because this was the first letter I received from China' in result.serialize())
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class RenderedDocumentCacheTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def test_get_set(self):
+        self.assertEqual(None, rendered_documents.get('allen.001'))
+        rendered_documents.set('allen.001', None, {'format': '<div/>'})
+        self.assertEqual({'format': '<div/>'}, rendered_documents.get('allen.001'))
+        self.assertEqual({'format': '<div/>'}, rendered_documents.get('allen.001', ''))
+        self.assertEqual(None, rendered_documents.get('allen.001', 'china'))
+
+    def test_normalized_keyword(self):
+        rendered_documents.set('allen.001', 'China  Letter', {'format': '<div/>'})
+        self.assertEqual({'format': '<div/>'},
+            rendered_documents.get('allen.001', ' china letter'),
+            'equivalent highlight terms should share a cache entry')
+
+    def test_stylesheet_version(self):
+        rendered_documents.set('allen.001', None, {'format': '<div/>'})
+        form = stylesheets.path('form')
+        mtime = path.getmtime(form)
+        try:
+            os.utime(form, (mtime + 10, mtime + 10))
+            self.assertEqual(None, rendered_documents.get('allen.001'),
+                'content rendered with a previous version of the stylesheet should not be used')
+        finally:
+            os.utime(form, (mtime, mtime))
+
+    def test_invalidate_collection(self):
+        generation = collection_generation()
+        rendered_documents.set('allen.001', None, {'format': '<div/>'})
+        self.assertEqual(generation + 1, invalidate_collection())
+        self.assertEqual(None, rendered_documents.get('allen.001'),
+            'content cached for a previous collection generation should not be used')
+
+        # an evicted generation starts again above every generation used
+        # before, even if the clock has not moved on
+        class StoppedClock(object):
+            def time(self):
+                return generation / 1000.0
+        clock = oxex_cache.time
+        oxex_cache.time = StoppedClock()
+        try:
+            cache.delete(oxex_cache.GENERATION_KEY)
+            self.assertEqual(generation + 2, collection_generation())
+            cache.delete(oxex_cache.GENERATION_KEY)
+            self.assertEqual(generation + 3, invalidate_collection())
+        finally:
+            oxex_cache.time = clock
+
+
+class DownloadTest(TestCase):
+
+    def test_accepted_encoding(self):
+        rf = RequestFactory()
+        self.assertEqual(None, accepted_encoding(rf.get('/')))
+        self.assertEqual('gzip', accepted_encoding(rf.get('/', HTTP_ACCEPT_ENCODING='gzip, deflate')))
+        self.assertEqual('deflate', accepted_encoding(rf.get('/', HTTP_ACCEPT_ENCODING='deflate')))
+        self.assertEqual('deflate', accepted_encoding(rf.get('/', HTTP_ACCEPT_ENCODING='gzip;q=0.5, deflate')))
+        self.assertEqual(None, accepted_encoding(rf.get('/', HTTP_ACCEPT_ENCODING='gzip;q=0, br')))
+        self.assertEqual('gzip', accepted_encoding(rf.get('/', HTTP_ACCEPT_ENCODING='*')))
+
+    def test_download_variant(self):
+        rf = RequestFactory()
+        self.assertEqual('download-identity', download_variant(rf.get('/')))
+        self.assertEqual('download-gzip', download_variant(rf.get('/', HTTP_ACCEPT_ENCODING='gzip')))
+        self.assertEqual('download-pretty', download_variant(rf.get('/', {'pretty': 1},
+                                                                    HTTP_ACCEPT_ENCODING='gzip')))
+
+    def test_compress_chunks(self):
+        chunks = ['<TEI>', 'some text ' * 100, '</TEI>']
+        gzipped = b''.join(compress_chunks(iter(chunks), 'gzip'))
+        self.assertEqual(''.join(chunks), zlib.decompress(gzipped, 16 + zlib.MAX_WBITS))
+        deflated = b''.join(compress_chunks(iter(chunks), 'deflate'))
+        self.assertEqual(''.join(chunks), zlib.decompress(deflated))
+
+
+class SummaryIndexTest(TestCase):
+    exist_fixtures = {'directory' : exist_fixture_path }
+
+    def setUp(self):
+        summary_index.load()
+
+    def test_load(self):
+        self.assertEqual(3, summary_index.count())
+        summary = summary_index.get('allen.001')
+        self.assert_(isinstance(summary, DocSummary))
+        self.assertEqual('K. T. Tsoong Letter, Jan 6, 1909, an electronic edition', summary.title)
+        self.assertEqual(None, summary_index.get('nonexistent'))
+
+    def test_ordered(self):
+        titles = [s.title for s in summary_index.ordered('title')]
+        self.assertEqual(sorted(titles, key=lambda t: t.lower()), titles)
+        self.assertEqual(list(reversed(titles)),
+            [s.title for s in summary_index.ordered('-title')])
+        self.assertRaises(ValueError, summary_index.ordered, 'text')
+
+    def test_memory_report(self):
+        report = summary_index.memory_report()
+        self.assertEqual(3, report['documents'])
+        self.assert_(report['bytes_per_document'] > 0)
+
+    @override_settings(OXEX_SUMMARY_INDEX=True)
+    def test_browse(self):
+        response = self.client.get(reverse('docs'))
+        self.assertEqual(3, response.context['docs_paginated'].paginator.count)
+        self.assertContains(response, reverse('doc_display', args=['allen.001']))
+
+
+class FacetIndexTest(TestCase):
+    exist_fixtures = {'directory' : exist_fixture_path }
+
+    def setUp(self):
+        self.index = FacetIndex()
+        self.index.load()
+
+    def facet_counts(self, facets, name):
+        facet = [f for f in facets if f['name'] == name][0]
+        return dict((v['value'], v['count']) for v in facet['values'])
+
+    def test_facets(self):
+        facets = self.index.facets()
+        self.assertEqual(['subject', 'geography', 'date'], [f['name'] for f in facets])
+        subjects = self.facet_counts(facets, 'subject')
+        self.assertEqual(3, subjects['Allen, Young John, 1836-1907.'])
+        self.assertEqual(2, subjects['College students--Georgia.'])
+        self.assertEqual(1, subjects['Missionaries--American--1880-1900.'])
+        self.assertEqual({'United States': 3}, self.facet_counts(facets, 'geography'))
+        self.assertEqual({'1800-1899': 3}, self.facet_counts(facets, 'date'))
+        # most frequent values first
+        counts = [v['count'] for v in facets[0]['values']]
+        self.assertEqual(sorted(counts, reverse=True), counts)
+
+    def test_documents(self):
+        self.assertEqual(3, len(self.index.documents()))
+        docs = self.index.documents({'subject': ['College students--Georgia.']})
+        self.assertEqual(2, len(docs))
+        self.assert_(all(isinstance(d, DocSummary) for d in docs))
+        docs = self.index.documents({'subject': ['College students--Georgia.',
+                                                 'Missionaries--American--1880-1900.']})
+        self.assertEqual(0, len(docs), 'selected values should all apply')
+        docs = self.index.documents({'subject': ['Missionaries--American--1880-1900.'],
+                                     'geography': ['United States']})
+        self.assertEqual(['oeAllen11-CandlerLetter'], [d.id for d in docs])
+        self.assertEqual(0, len(self.index.documents({'date': ['1900-1999']})))
+
+        facets = self.index.facets({'subject': ['Missionaries--American--1880-1900.']})
+        self.assertEqual({'United States': 1}, self.facet_counts(facets, 'geography'))
+        selected = [v for v in facets[0]['values'] if v['selected']]
+        self.assertEqual(['Missionaries--American--1880-1900.'], [v['value'] for v in selected])
+
+    def test_browse_disabled(self):
+        response = self.client.get(reverse('docs'), {'subject': 'Missionaries--American--1880-1900.'})
+        self.assertEqual(None, response.context['facets'])
+        self.assertEqual(3, response.context['docs_paginated'].paginator.count)
+
+    @override_settings(OXEX_FACET_INDEX=True)
+    def test_browse(self):
+        response = self.client.get(reverse('docs'))
+        self.assertEqual(3, response.context['docs_paginated'].paginator.count)
+        response = self.client.get(reverse('docs'), {'subject': 'Missionaries--American--1880-1900.'})
+        self.assertEqual(1, response.context['docs_paginated'].paginator.count)
+        self.assertContains(response, reverse('doc_display', args=['oeAllen11-CandlerLetter']))
+        self.assertNotContains(response, reverse('doc_display', args=['allen.001']))
+        self.assertEqual('subject=Missionaries--American--1880-1900.', response.context['filter_query'])
+        self.assertContains(response, 'College students--Georgia.',
+            msg_prefix='browse page should list facet values')
+
+
+class ResultSetCacheTest(TestCase):
+
+    def setUp(self):
+        self.result_sets = ResultSetCache(max_size=2, ttl=60)
+
+    def test_canonical_key(self):
+        self.assertEqual(self.result_sets.key({'keyword': ' China  Letter', 'title': ''}),
+                         self.result_sets.key({'keyword': 'china letter', 'author': None}))
+        self.assertNotEqual(self.result_sets.key({'keyword': 'china'}),
+                            self.result_sets.key({'title': 'china'}))
+        self.assertNotEqual(self.result_sets.key({'keyword': 'china AND letter'}),
+                            self.result_sets.key({'keyword': 'china and letter'}),
+            'boolean operators should not be case-folded')
+        self.assertEqual(self.result_sets.key({'keyword': 'China NOT Letter'}),
+                         self.result_sets.key({'keyword': 'china NOT letter'}))
+
+    def test_too_many_clauses(self):
+        self.assert_(too_many_clauses(ExistDBException(
+            'org.apache.lucene.search.BooleanQuery$TooManyClauses: maxClauseCount is set to 1024')))
+        self.assertFalse(too_many_clauses(ExistDBException('Cannot parse "(china"')))
+
+    def test_lru(self):
+        self.assertEqual(None, self.result_sets.get('a'))
+        self.result_sets.set('a', ['doc1', 'doc2'])
+        self.result_sets.set('b', ['doc3'])
+        self.assertEqual(('doc1', 'doc2'), self.result_sets.get('a'))
+        # b is now least recently used and should be evicted
+        self.result_sets.set('c', [])
+        self.assertEqual(None, self.result_sets.get('b'))
+        self.assertEqual((), self.result_sets.get('c'))
+        self.assertEqual(2, self.result_sets.stats()['hits'])
+        self.assertEqual(2, self.result_sets.stats()['misses'])
+
+    def test_ttl(self):
+        result_sets = ResultSetCache(max_size=2, ttl=-1)
+        result_sets.set('a', ['doc1'])
+        self.assertEqual(None, result_sets.get('a'), 'expired result set should not be returned')
+        self.assertEqual(0, result_sets.stats()['size'])
+
+
+class KwicSnippetsTest(TestCase):
+
+    def test_kwic_xquery(self):
+        xquery = kwic_xquery(['allen.001', 'oeAllenBio'], 'say "china"')
+        self.assert_('@xml:id = ("allen.001", "oeAllenBio")' in xquery,
+            'query should select all documents on the page at once')
+        self.assert_('ft:query(., "say ""china""")' in xquery)
+
+    def test_format_snippets(self):
+        results = etree.fromstring('''<results>
+          <doc id="allen.001"><p><span class="previous">letter I received from </span>
+            <span class="hi">China</span><span class="following"> since I left</span></p></doc>
+          <doc id="oeAllenBio"/>
+        </results>''')
+        snippets = format_snippets(etree.ElementTree(results))
+        self.assertEqual(['allen.001'], snippets.keys(),
+            'documents without matches should not have a snippet')
+        self.assert_('<span class="match">China</span>' in snippets['allen.001'])
+        self.assert_('letter I received from' in snippets['allen.001'])
+
+
+class ExistConnectionTest(TestCase):
+
+    def test_shared_db(self):
+        db = get_exist_db()
+        self.assert_(db is get_exist_db(), 'eXist connection should be shared within a worker')
+        self.assert_(DocTitle.objects.all()._db is db,
+            'model querysets should use the shared eXist connection')
+        self.assert_(Doc.objects.all()._db is db)
+
+    def test_pool_stats(self):
+        stats = pool_stats()
+        self.assert_('max_connections' in stats)
+        for pool in stats['pools']:
+            self.assert_(pool['idle'] <= pool['connections'])
+
+
+class InstrumentationTest(TestCase):
+
+    def setUp(self):
+        query_log.clear()
+
+    def test_percentile(self):
+        values = range(1, 101)
+        self.assertEqual(50, percentile(values, 50))
+        self.assertEqual(99, percentile(values, 99))
+        self.assertEqual(None, percentile([], 50))
+
+    @override_settings(OXEX_SLOW_QUERY_MS=100)
+    def test_instrument_view(self):
+        @instrument_view
+        def view(request):
+            record_query('collection("/db/oxex")/tei:TEI', 0.02, size=512, hits=3, count=3)
+            record_query('collection("/db/oxex")//tei:text', 0.25, size=2048, hits=10, count=10)
+            return HttpResponse()
+
+        request = RequestFactory().get('/')
+        response = view(request)
+        self.assertEqual(2, len(request.exist_queries))
+        self.assert_(response['Server-Timing'].startswith('exist;dur=270.0;desc="2 eXist queries"'))
+        self.assertEqual(1, len(query_log.slow_queries),
+            'only queries over the threshold should be in the slow query log')
+        self.assertEqual('view', query_log.slow_queries[0]['view'])
+        stats = query_log.view_stats()
+        self.assertEqual('view', stats[0]['view'])
+        self.assertEqual(1, stats[0]['requests'])
+        self.assertEqual(2, stats[0]['queries']['p50'])
+
+    def test_stats_staff_only(self):
+        response = self.client.get(reverse('stats'))
+        self.assertEqual(403, response.status_code,
+            'stats page should be forbidden to anonymous users')
+
+
+class BenchmarkTest(TestCase):
+
+    def test_synthesize_corpus(self):
+        corpus = list(synthesize_corpus(7))
+        self.assertEqual(7, len(corpus))
+        ids = [doc_id for doc_id, xml in corpus]
+        self.assertEqual(7, len(set(ids)), 'synthesized documents should have unique ids')
+        doc = xmlmap.load_xmlobject_from_string(corpus[4][1], DocTitle)
+        self.assertEqual(ids[4], doc.id)
+        self.assertEqual('oeAllenBio.bench00003', ids[3],
+            'fixtures should be reused in order with a numbered id')
+
+
+class FulltextIndexTest(TestCase):
+
+    def setUp(self):
+        self.index = FulltextIndex(directory=exist_fixture_path)
+        self.index.build()
+
+    def ids(self, **filters):
+        return [doc.id for doc in self.index.search(filters)]
+
+    def test_build(self):
+        self.assertRaises(ImproperlyConfigured, FulltextIndex(directory='').build)
+        # documents in subdirectories are indexed, as they are loaded by load_tei
+        tmpdir = tempfile.mkdtemp()
+        try:
+            shutil.copytree(exist_fixture_path, path.join(tmpdir, 'letters'))
+            index = FulltextIndex(directory=tmpdir)
+            self.assertEqual(len(self.index.build()), len(index.build()))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_tokenize(self):
+        self.assertEqual(['letter', 'young', 'john', 'allen'],
+                         tokenize('Letter to Young John Allen'))
+
+    def test_postings(self):
+        a = array('I', [1, 3, 5, 7])
+        b = array('I', [3, 4, 7, 9])
+        self.assertEqual([3, 7], list(intersect(a, b)))
+        self.assertEqual([1, 3, 4, 5, 7, 9], list(union([a, b])))
+        self.assertEqual([1, 5], list(difference(a, b)))
+
+    def test_field_search(self):
+        self.assertEqual(['oeAllen11-CandlerLetter'], self.ids(author__fulltext_terms='Candler'))
+        self.assertEqual(['oeAllen11-CandlerLetter'], self.ids(date__fulltext_terms='1892'))
+        self.assertEqual(['allen.001', 'oeAllen11-CandlerLetter'],
+                         self.ids(title__fulltext_terms='letter'),
+            'results should be in title order')
+        self.assertEqual(['oeAllen11-CandlerLetter'],
+                         self.ids(title__fulltext_terms='letter', date__fulltext_terms='1892'),
+            'multiple filters should all match')
+
+    def test_keyword_search(self):
+        self.assertEqual(2, len(self.ids(fulltext_terms='missionary')))
+        self.assertEqual(self.ids(fulltext_terms='missionary'), self.ids(fulltext_terms='mission*'))
+        self.assertEqual(['allen.001'], self.ids(fulltext_terms='+missionary +roommate'))
+        self.assertEqual(['oeAllen11-CandlerLetter'], self.ids(fulltext_terms='missionary -roommate'))
+        self.assertEqual(['allen.001'], self.ids(fulltext_terms='missionary AND (roommate OR nonesuch)'))
+        self.assertEqual([], self.ids(fulltext_terms='the'),
+            'stop words should not be indexed')
+        # publicationStmt is not indexed
+        self.assertEqual([], self.ids(fulltext_terms='Beck'))
+
+    def test_wildcard_expansion(self):
+        self.assertEqual(['missionaries', 'missionary'],
+                         self.index.expand('keyword', 'missi*'))
+        self.assertEqual(['missionary'], self.index.expand('keyword', 'missionar?'))
+        self.assertEqual([], self.index.expand('keyword', 'zzz*'))
+        with override_settings(OXEX_WILDCARD_MAX_TERMS=1):
+            self.assertRaises(TooManyTermsError, self.index.expand, 'keyword', 'missi*')
+        self.assertRaises(SearchQueryError, self.index.expand, 'keyword', '*ssion')
+        with override_settings(EXISTDB_FULLTEXT_OPTIONS={'leading-wildcard': 'yes'}):
+            self.assert_('impression' in self.index.expand('keyword', '*ssion'))
+
+    @override_settings(OXEX_SEARCH_BACKEND='local', OXEX_TEI_DIRECTORY=exist_fixture_path,
+                       OXEX_WILDCARD_MAX_TERMS=1)
+    def test_searchbox_too_many_terms(self):
+        response = self.client.get(reverse('search'), {'keyword': 'missi*'})
+        self.assertEqual(400, response.status_code)
+        self.assertContains(response, 'matches too many words', status_code=400)
+
+    def test_query_errors(self):
+        self.assertRaises(SearchQueryError, self.index.search, {'fulltext_terms': '"missionary'})
+        self.assertRaises(SearchQueryError, self.index.search, {'fulltext_terms': '(missionary'})
+        self.assertRaises(SearchQueryError, self.index.search, {'text__contains': 'missionary'})
+
+    @override_settings(OXEX_SEARCH_BACKEND='local', OXEX_TEI_DIRECTORY=exist_fixture_path)
+    def test_searchbox(self):
+        response = self.client.get(reverse('search'), {'author': 'Candler'})
+        self.assertEqual(200, response.status_code)
+        self.assertContains(response, reverse('doc_display', args=['oeAllen11-CandlerLetter']))
+        response = self.client.get(reverse('search'), {'title': '(letter'})
+        self.assertEqual(400, response.status_code)
+
+
+class StaticExportTest(TestCase):
+    exist_fixtures = {'directory' : exist_fixture_path }
+
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp(prefix='oxex-export-')
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def test_export(self):
+        call_command('export_static', self.output_dir, processes=1, verbosity=0)
+        with open(path.join(self.output_dir, 'manifest.json')) as manifest_file:
+            manifest = json.load(manifest_file)
+        self.assertEqual(0, manifest['failed'])
+        self.assert_('oeAllen11-CandlerLetter' in manifest['documents'])
+        for f in manifest['documents']['oeAllen11-CandlerLetter']['files']:
+            self.assert_(path.exists(path.join(self.output_dir, f)), 'exported file %s should exist' % f)
+        self.assert_(path.exists(path.join(self.output_dir, 'browse', 'index.html')))
+
+        # unchanged documents are skipped on the next export
+        call_command('export_static', self.output_dir, processes=1, verbosity=0)
+        with open(path.join(self.output_dir, 'manifest.json')) as manifest_file:
+            manifest = json.load(manifest_file)
+        self.assertEqual(0, manifest['rendered'])
+        self.assertEqual(len(manifest['documents']), manifest['skipped'])
+
+        # files for documents no longer in the collection are removed, even
+        # when every document is rendered again
+        removed_dir = path.join(self.output_dir, 'removed')
+        os.makedirs(removed_dir)
+        with open(path.join(removed_dir, 'index.html'), 'w') as removed:
+            removed.write('<html/>')
+        manifest['documents']['removed'] = {'hash': 'x', 'files': ['removed/index.html']}
+        with open(path.join(self.output_dir, 'manifest.json'), 'w') as manifest_file:
+            json.dump(manifest, manifest_file)
+        call_command('export_static', self.output_dir, processes=1, verbosity=0, force=True)
+        self.assertFalse(path.exists(removed_dir))
+        with open(path.join(self.output_dir, 'manifest.json')) as manifest_file:
+            manifest = json.load(manifest_file)
+        self.assertEqual(len(manifest['documents']), manifest['rendered'])
+
+    def test_static_page_links(self):
+        self.assertEqual('<a href="page-2.html">2</a> <a href="/x/">x</a>',
+                         static_page_links('<a href="?page=2">2</a> <a href="/x/">x</a>'))
+
+
+class IngestTest(TestCase):
+
+    def setUp(self):
+        self.collection = '%s_ingest' % settings.EXISTDB_ROOT_COLLECTION.rstrip('/')
+
+    def tearDown(self):
+        db = get_exist_db()
+        if db.hasCollection(self.collection):
+            db.removeCollection(self.collection)
+        if db.hasCollectionIndex(self.collection):
+            db.removeCollectionIndex(self.collection)
+
+    def test_tei_files(self):
+        files = tei_files(exist_fixture_path)
+        self.assertEqual(3, len(files))
+        self.assertEqual('/db/oxex/allen.xml',
+                         exist_path('/db/oxex/', exist_fixture_path, path.join(exist_fixture_path, 'allen.xml')))
+
+    def test_load_directory(self):
+        generation = collection_generation()
+        report = load_directory(exist_fixture_path, self.collection, threads=2)
+        self.assertEqual(3, report.documents)
+        self.assertEqual([], report.failures)
+        self.assertEqual(sum(path.getsize(f) for f in tei_files(exist_fixture_path)), report.bytes)
+        self.assert_(get_exist_db().hasCollectionIndex(self.collection),
+            'index configuration should be installed')
+        self.assertNotEqual(generation, collection_generation(),
+            'loading documents should start a new collection generation')
+
+    def test_load_directory_failure(self):
+        def fail(uploads, threads, report):
+            raise IOError('upload failed')
+        upload = ingest.upload_files
+        ingest.upload_files = fail
+        try:
+            self.assertRaises(IOError, load_directory, exist_fixture_path, self.collection)
+        finally:
+            ingest.upload_files = upload
+        self.assert_(get_exist_db().hasCollectionIndex(self.collection),
+            'index configuration should be restored when the upload fails')
+
+    def test_incremental_load(self):
+        directory = tempfile.mkdtemp(prefix='oxex-ingest-')
+        try:
+            for f in tei_files(exist_fixture_path):
+                shutil.copy(f, directory)
+            report = load_directory(directory, self.collection)
+            self.assertEqual(3, report.documents)
+            self.assertEqual(collection_generation(), report.generation)
+
+            # nothing changed: nothing uploaded, same generation
+            report = load_directory(directory, self.collection)
+            self.assertEqual(0, report.documents)
+            self.assertEqual(3, report.unchanged)
+            self.assertEqual(collection_generation(), report.generation)
+            generation = report.generation
+
+            with open(path.join(directory, 'allen.xml'), 'a') as tei:
+                tei.write('<!-- edited -->')
+            os.remove(path.join(directory, 'Allen_Bio.xml'))
+            report = load_directory(directory, self.collection)
+            self.assertEqual(1, report.documents, 'only the changed file should be uploaded')
+            self.assertEqual(1, report.removed)
+            self.assertNotEqual(generation, report.generation)
+            db = get_exist_db()
+            self.assertFalse(db.hasDocument('%s/Allen_Bio.xml' % self.collection))
+            with open(path.join(directory, '.oxex-ingest.json')) as manifest_file:
+                manifest = json.load(manifest_file)
+            self.assertEqual(['Allen11-CandlerLetter.xml', 'allen.xml'], sorted(manifest['files']))
+        finally:
+            shutil.rmtree(directory)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class DCRecordStoreTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.docs = {'Allen11-CandlerLetter': xmlmap.load_xmlobject_from_file(
+            path.join(exist_fixture_path, 'Allen11-CandlerLetter.xml'), DocTitle)}
+
+    def test_dc_record(self):
+        record = dc_record(self.docs['Allen11-CandlerLetter'])
+        self.assertEqual('Letter to Young John Allen, February 6, 1892, an electronic edition',
+                         record['title'])
+        self.assert_('Allen, Young John, 1836-1907.' in record['subject_list'])
+        self.assert_('United States' in record['coverage_list'])
+        dc = xmlmap.load_xmlobject_from_string(record['xml'].encode('utf-8'), xmlmap.dc.DublinCore)
+        self.assertEqual(record['title'], dc.title, 'serialized oai_dc should match the record')
+
+    def test_dc_record_no_header(self):
+        # Allen_Bio fixture has no TEI header in the TEI namespace
+        doc = xmlmap.load_xmlobject_from_file(path.join(exist_fixture_path, 'Allen_Bio.xml'),
+                                              DocTitle)
+        record = dc_record(doc)
+        self.assertEqual(None, record['title'])
+        self.assertEqual([], record['creator_list'])
+        dc = xmlmap.load_xmlobject_from_string(record['xml'].encode('utf-8'), xmlmap.dc.DublinCore)
+        self.assertEqual(None, dc.title)
+        # ingest should not fail on a headerless document
+        self.assertEqual(3, populate_dc_records(tei_files(exist_fixture_path)))
+
+    def test_store(self):
+        doc = self.docs['Allen11-CandlerLetter']
+        self.assertEqual(1, dc_records.populate([doc]))
+        # populated records are used without the document
+        self.assertEqual(dc_record(doc), dc_records.get(doc.id))
+        self.assertEqual([doc.id], dc_records.get_many([doc.id]).keys())
+        invalidate_collection()
+        self.assertEqual(dc_record(doc), dc_records.get(doc.id, doc),
+            'records should be rebuilt for a new collection generation')
+
+
+class OAITest(TestCase):
+    exist_fixtures = {'directory' : exist_fixture_path }
+
+    def oai(self, **params):
+        response = self.client.get(reverse('oai'), params)
+        self.assertEqual(200, response.status_code)
+        return response
+
+    def resumption_token(self, response):
+        match = re.search(r'<resumptionToken cursor="\d+">([^<]*)</resumptionToken>', response.content)
+        return match.group(1) if match else None
+
+    def harvest(self, verb, **params):
+        # follow resumption tokens to the end of a list; returns the responses
+        responses = [self.oai(verb=verb, **params)]
+        token = self.resumption_token(responses[-1])
+        while token:
+            responses.append(self.oai(verb=verb, resumptionToken=token))
+            token = self.resumption_token(responses[-1])
+        return responses
+
+    @override_settings(OXEX_OAI_BATCH_SIZE=1)
+    def test_list_identifiers(self):
+        responses = self.harvest('ListIdentifiers', metadataPrefix='oai_dc')
+        self.assert_(len(responses) > 1, 'list should be split into batches')
+        for response in responses:
+            self.assertContains(response, '<header>', 1)
+        self.assertEqual('', self.resumption_token(responses[-1]),
+            'last batch of a resumed list should have an empty resumption token')
+        self.assertContains(responses[0], '<resumptionToken cursor="0">')
+
+        token = self.resumption_token(responses[0])
+        invalidate_collection()
+        response = self.oai(verb='ListIdentifiers', resumptionToken=token)
+        self.assertContains(response, 'badResumptionToken',
+            msg_prefix='tokens should expire when the collection changes')
+
+    @override_settings(OXEX_OAI_BATCH_SIZE=1)
+    def test_list_records(self):
+        responses = self.harvest('ListRecords', metadataPrefix='oai_dc')
+        for response in responses:
+            self.assertContains(response, '<record>', 1)
+            self.assertContains(response, '<oai_dc:dc', 1)
+        self.assert_(any('<dc:title>Letter to Young John Allen, February 6, 1892, an electronic edition</dc:title>'
+                         in response.content for response in responses),
+            'record metadata should include the Dublin Core title')
+        self.assertContains(self.oai(verb='ListRecords'), 'badArgument')
+
+    def test_selective_harvest(self):
+        all_headers = self.oai(verb='ListIdentifiers', metadataPrefix='oai_dc').content.count('<header>')
+        response = self.oai(verb='ListIdentifiers', metadataPrefix='oai_dc', **{'from': '2000-01-01'})
+        self.assertEqual(all_headers, response.content.count('<header>'))
+        response = self.oai(verb='ListRecords', metadataPrefix='oai_dc', **{'until': '2000-01-01'})
+        self.assertContains(response, 'noRecordsMatch',
+            msg_prefix='no records were modified before the fixtures were loaded')
+        response = self.oai(verb='ListIdentifiers', metadataPrefix='oai_dc',
+                            **{'from': '2000-01-01', 'until': '2000-01-01T00:00:00Z'})
+        self.assertContains(response, 'badArgument')
+
+    def test_compression(self):
+        plain = self.oai(verb='ListRecords', metadataPrefix='oai_dc')
+        self.assertEqual('Accept-Encoding', plain['Vary'])
+        self.assertFalse(plain.has_header('Content-Encoding'))
+        response = self.client.get(reverse('oai'), {'verb': 'ListRecords', 'metadataPrefix': 'oai_dc'},
+                                   HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual('gzip', response['Content-Encoding'])
+        compressed = b''.join(response.streaming_content)
+        content = zlib.decompress(compressed, 16 + zlib.MAX_WBITS)
+        self.assertEqual(plain.content.count('<record>'), content.count('<record>'))
+        self.assert_(len(compressed) < len(content))
+        response = self.client.get(reverse('oai'), {'verb': 'Identify'}, HTTP_ACCEPT_ENCODING='deflate')
+        self.assertEqual('deflate', response['Content-Encoding'])
+        content = zlib.decompress(b''.join(response.streaming_content))
+        self.assert_('<compression>gzip</compression>' in content)
+        self.assert_('<compression>deflate</compression>' in content)
+
+    def test_list_sets(self):
+        response = self.oai(verb='ListSets')
+        specs = re.findall(r'<setSpec>([^<]+)</setSpec>', response.content)
+        self.assert_('subject' in specs, 'LCSH subjects should be listed as a set')
+        subsets = [spec for spec in specs if spec.startswith('subject:')]
+        self.assert_(subsets, 'each LCSH subject should be listed as a subset')
+
+        response = self.oai(verb='ListIdentifiers', metadataPrefix='oai_dc', set=subsets[0])
+        headers = re.findall(r'<header>.*?</header>', response.content, re.DOTALL)
+        self.assert_(headers)
+        for header in headers:
+            self.assert_('<setSpec>%s</setSpec>' % subsets[0] in header,
+                'every record listed for a set should be in the set')
+        response = self.oai(verb='ListRecords', metadataPrefix='oai_dc', set='subject:no-such-subject')
+        self.assertContains(response, 'noRecordsMatch')
+
+    def test_utc_datestamps(self):
+        # eXist last-modified times are in the server timezone
+        self.assertEqual(datetime(2015, 1, 1, 15, 0, 0),
+                         utc_datestamp('2015-01-01T10:00:00.123-05:00'))
+        self.assertEqual(datetime(2014, 12, 31, 23, 30), utc_datestamp('2015-01-01T00:30:00+01:00'))
+        self.assertEqual(datetime(2015, 1, 1, 10, 0), utc_datestamp('2015-01-01T10:00:00Z'))
+        self.assertRaises(ValueError, utc_datestamp, 'January 1, 2015')
+
+        # providers may give datestamps with a timezone; from and until are UTC
+        class Provider(OAIProvider):
+            def items(self):
+                return ['a']
+            def last_modified(self, obj):
+                return datetime(2015, 1, 1, 20, 0, tzinfo=get_fixed_timezone(-5 * 60))
+        provider = Provider()
+        self.assertEqual(['a'], provider.filtered_items(parse_datestamp('2015-01-02')))
+        self.assertEqual([], provider.filtered_items(until_date=parse_datestamp('2015-01-01', until=True)))
+        self.assertEqual('2015-01-02T01:00:00Z', provider.item_info('a')['datestamp'])
+
+    def test_list_batch_generator(self):
+        # items() may be a generator, which cannot be sliced
+        class Provider(OAIProvider):
+            batch_size = 2
+            def items(self):
+                return (i for i in 'abcde')
+        provider = Provider()
+        provider.from_date = provider.until_date = provider.set_spec = None
+        provider.oai_args = {'verb': 'ListIdentifiers', 'metadataPrefix': 'oai_dc'}
+        provider.cursor = 2
+        batch, token = provider.list_batch()
+        self.assertEqual(['c', 'd'], batch)
+        self.assert_(token)
+        provider.cursor = 4
+        self.assertEqual((['e'], ''), provider.list_batch())
+
+    def test_get_record(self):
+        identifier = 'oai:beck.library.emory.edu:oeAllen11-CandlerLetter'
+        response = self.oai(verb='GetRecord', identifier=identifier, metadataPrefix='oai_dc')
+        self.assertContains(response, '<identifier>%s</identifier>' % identifier)
+        self.assertContains(response, '<oai_dc:dc')
+        self.assert_(response.has_header('ETag'))
+        self.assert_(response.has_header('Last-Modified'))
+
+        response = self.client.get(reverse('oai'), {'verb': 'GetRecord', 'identifier': identifier,
+                                   'metadataPrefix': 'oai_dc'}, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(304, response.status_code,
+            'unchanged record should return 304 for a matching ETag')
+
+        self.assertContains(self.oai(verb='GetRecord', identifier='oai:beck.library.emory.edu:bogus',
+                                     metadataPrefix='oai_dc'), 'idDoesNotExist')
+        self.assertContains(self.oai(verb='GetRecord', identifier=identifier), 'badArgument')
+
+    def test_list_identifiers_errors(self):
+        self.assertContains(self.oai(verb='ListIdentifiers'), 'badArgument')
+        self.assertContains(self.oai(verb='ListIdentifiers', metadataPrefix='mods'),
+                            'cannotDisseminateFormat')
+        self.assertContains(self.oai(verb='ListIdentifiers', resumptionToken='bogus'),
+                            'badResumptionToken')
+        self.assertContains(self.oai(verb='Bogus'), 'badVerb')
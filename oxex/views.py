@@ -6,56 +6,120 @@ from django.shortcuts import render, render_to_response
 from django.http import HttpResponse, Http404
 from django.core.paginator import Paginator, InvalidPage, EmptyPage, PageNotAnInteger
 from django.template import RequestContext
+from django.template.loader import render_to_string
 from django.shortcuts import redirect
 from django.contrib import messages
+from django.core.exceptions import PermissionDenied
 
 from oxex.models import DocTitle, Doc, Bibliography, SourceDescription, DocSearch
 from oxex.forms import DocSearchForm
+from oxex.paginator import ExistPaginator, ResultPaginator
+from oxex.search import search_documents, search_results, search_options, result_sets, \
+     too_many_clauses
+from oxex.fulltext import fulltext_index, SearchQueryError, TooManyTermsError
+from oxex.stylesheets import transform, stylesheets
+from oxex.cache import rendered_documents
+from oxex.dublincore import dc_records
+from oxex.conditional import document_condition
+from oxex.download import document_download, download_variant
+from oxex.summary import summary_index
+from oxex.facets import facet_index, FACETS
+from oxex.kwic import add_kwic_snippets
+from oxex.instrumentation import instrument_view, query_log
+from oxex.existdb import pool_stats
 
 from eulcommon.djangoextras.http.decorators import content_negotiation
 from eulexistdb.query import escape_string
 from eulexistdb.exceptions import DoesNotExist
 from eulexistdb.db import ExistDBException 
+
+def facet_query(selected):
+  'Query string for a selection of facet values.'
+  return urlencode([(name, value.encode('utf-8')) for name, label, field in FACETS
+                    for value in selected.get(name, [])])
+
+def facet_urls(facets, selected):
+  '''Facets for display, with the query string to select (or, if
+  selected, deselect) each facet value.'''
+  display = []
+  for facet in facets:
+    values = []
+    for value in facet['values']:
+      toggled = dict((name, list(v)) for name, v in selected.iteritems())
+      if value['selected']:
+        toggled[facet['name']].remove(value['value'])
+      else:
+        toggled.setdefault(facet['name'], []).append(value['value'])
+      values.append(dict(value, query=facet_query(toggled)))
+    display.append(dict(facet, values=values))
+  return display
+
+
+@instrument_view
 def docs(request):
   docs =DocTitle.objects.only('id', 'title', 'date', 'author').order_by('date')
   number_of_results = 26
-  context = {}
+  context = {'facets': None, 'filter_query': ''}
 
-  if 'subject' in request.GET:
-    context['subject'] = DocTitle.objects.only('id', 'title', 'date', 'author').order_by('date')
-  
-  docs_paginator = Paginator(list(docs), number_of_results)
+  if facet_index.enabled:
+    # facet values selected, e.g. ?subject=...&geography=...
+    selected = {}
+    for name, label, field in FACETS:
+      values = [v for v in request.GET.getlist(name) if v.strip()]
+      if values:
+        selected[name] = values
+    context['facets'] = facet_urls(facet_index.facets(selected), selected)
+    context['filter_query'] = facet_query(selected)
+    # browse, filtered or not, from the facet index without an eXist query
+    docs_paginator = ResultPaginator(facet_index.documents(selected), number_of_results)
+  elif summary_index.enabled:
+    # browse from the in-process summary index without an eXist query
+    docs_paginator = ResultPaginator(summary_index.ordered('date'), number_of_results)
+  else:
+    # let eXist window the results; only the requested page is retrieved
+    docs_paginator = ExistPaginator(docs, number_of_results)
   try:
     page = int(request.GET.get('page', '1'))
   except ValueError:
     page = 1
-  try:
-    docs_page = docs_paginator.page(page)
-  except (EmptyPage, InvalidPage):
-    docs_page = docs_paginator.page(paginator.num_pages)
+  docs_page = docs_paginator.page_or_last(page)
 
   context['docs_paginated'] = docs_page
   return render_to_response('docs.html', context, context_instance=RequestContext(request))
   #return render(request, 'docs.html', {'docs_paginated' : docs_page, 'context':context})
   #context_instance=RequestContext(request)
 
+@instrument_view
+@document_condition('display')
 def doc_display(request, doc_id):
   "Display the contents of a single document."
-  if 'keyword' in request.GET:
-    search_terms = request.GET['keyword']
-    url_params = '?' + urlencode({'keyword': search_terms})
-    highlighter = {'highlight': search_terms}
-  else:
-    url_params = ''
-    highlighter = {}   
-  try:
-    #doc = DocTitle.objects.get(id__exact=doc_id)
-    doc = DocTitle.objects.filter(**highlighter).get(id=doc_id)
-    format = doc.xsl_transform(filename=os.path.join(settings.BASE_DIR, '..', 'oxex', 'xslt', 'form.xsl'))
-    return render(request, 'doc_display.html', {'doc': doc, 'format': format.serialize()})
-  except DoesNotExist:
-    raise Http404
+  search_terms = request.GET.get('keyword', '')
+  # serve popular documents from the rendered document cache
+  rendered = rendered_documents.get(doc_id, search_terms)
+  if rendered is None:
+    if search_terms:
+      highlighter = {'highlight': search_terms}
+    else:
+      highlighter = {}
+    try:
+      #doc = DocTitle.objects.get(id__exact=doc_id)
+      doc = DocTitle.objects.filter(**highlighter).get(id=doc_id)
+    except DoesNotExist:
+      raise Http404
+    # form.xsl is compiled once and reused from the stylesheet registry
+    format = transform(doc, 'form')
+    rendered = {
+      'format': format.serialize(),
+      'dc_meta': render_to_string('dc_meta.html', {'dc_fields': dc_records.get(doc_id, doc)}),
+    }
+    rendered_documents.set(doc_id, search_terms, rendered)
+
+  context = {'doc_id': doc_id}
+  context.update(rendered)
+  return render(request, 'doc_display.html', context)
 
+@instrument_view
+@document_condition('xml')
 def doc_xml(request, doc_id):
   "Display the original TEI XML for a single document."
   try:
@@ -66,12 +130,20 @@ def doc_xml(request, doc_id):
   except DoesNotExist:
     raise Http404
 
+@instrument_view
+@document_condition(download_variant)
 def doc_down(request, doc_id):
   "Download the original TEI XML for a single document."
   try:
-    doc = DocTitle.objects.get(id__exact=doc_id)
-    xml_tei = doc.serialize(pretty=True)
-    return HttpResponse(xml_tei, content_type='application/tei+xml')
+    if 'pretty' in request.GET:
+      doc = DocTitle.objects.get(id__exact=doc_id)
+      xml_tei = doc.serialize(pretty=True)
+      return HttpResponse(xml_tei, content_type='application/tei+xml')
+
+    # stream the stored document from eXist without building it in memory
+    doc = DocTitle.objects.only('document_name', 'collection_name').get(id__exact=doc_id)
+    return document_download(request, '%s/%s' % (doc.collection_name, doc.document_name),
+                             'application/tei+xml')
   except DoesNotExist:
     raise Http404
     
@@ -79,41 +151,43 @@ def overview(request):
    "About the Oxford Experience."
    return render(request, 'overview.html')
  
+@instrument_view
 def searchbox(request):
     query_error = False
     "Search documents by keyword/title/author/date"
     form = DocSearchForm(request.GET)
     response_code = None
     context = {'searchbox': form}
-    search_opts = {}
     number_of_results = 10
     
     if form.is_valid():
-        if 'title' in form.cleaned_data and form.cleaned_data['title']:
-            search_opts['title__fulltext_terms'] = '%s' % form.cleaned_data['title']
-        if 'author' in form.cleaned_data and form.cleaned_data['author']:
-            search_opts['author__fulltext_terms'] = '%s' % form.cleaned_data['author']
-        if 'keyword' in form.cleaned_data and form.cleaned_data['keyword']:
-            search_opts['fulltext_terms'] = '%s' % form.cleaned_data['keyword']
-        if 'date' in form.cleaned_data and form.cleaned_data['date']:
-            search_opts['date__fulltext_terms'] = '%s' % form.cleaned_data['date']
-
         try:
-            docs = DocTitle.objects.only('id', 'title', 'date', 'author').filter(**search_opts).order_by('title')
-            if 'keyword' in form.cleaned_data and form.cleaned_data['keyword']:
-                docs = docs.only_raw(line_matches='%%(xq_var)s//text[ft:query(., "%s")]' \
-                                    % escape_string(form.cleaned_data['keyword']))
-
-            searchbox_paginator = Paginator(list(docs), number_of_results)
+            if fulltext_index.enabled:
+                # matching documents come from the in-process full-text
+                # index, already in title order, without an eXist query
+                docs = fulltext_index.search(search_options(form.cleaned_data))
+                searchbox_paginator = ResultPaginator(docs, number_of_results)
+            elif result_sets.enabled:
+                # ordered hit ids are cached, so paging through results
+                # only fetches the documents on the requested page
+                docs = search_results(form.cleaned_data)
+                searchbox_paginator = ResultPaginator(docs, number_of_results)
+            else:
+                docs = search_documents(form.cleaned_data)
+                # total comes from the eXist hit count; only the requested
+                # window of titles is retrieved
+                searchbox_paginator = ExistPaginator(docs, number_of_results)
             try:
                 page = int(request.GET.get('page', '1'))
             except ValueError:
                 page = 1
             # If page request (9999) is out of range, deliver last page of results.
-            try:
-                searchbox_page = searchbox_paginator.page(page)
-            except (EmptyPage, InvalidPage):
-                searchbox_page = searchbox_paginator.page(paginator.num_pages)
+            searchbox_page = searchbox_paginator.page_or_last(page)
+            if form.cleaned_data['keyword'] and not fulltext_index.enabled:
+                # context snippets for the whole page in one query; not
+                # available with the local backend, which does not use eXist
+                searchbox_page.object_list = add_kwic_snippets(searchbox_page.object_list,
+                                                               form.cleaned_data['keyword'])
 
             context['docs_paginated'] = searchbox_page
             context['keyword'] = form.cleaned_data['keyword']
@@ -123,11 +197,25 @@ def searchbox(request):
            
             response = render_to_response('search.html', context, context_instance=RequestContext(request))
      
+        except TooManyTermsError as e:
+            query_error = True
+            messages.error(request, 'Your search term %s matches too many words.  ' % e.term +
+                           'Please use a longer word before the * and try again.')
+            response = render(request, 'search.html',{'searchbox': form, 'request': request})
+
+        except SearchQueryError:
+            query_error = True
+            messages.error(request, 'Your search query could not be parsed.  ' + 'Please revise your search and try again.')
+            response = render(request, 'search.html',{'searchbox': form, 'request': request})
+
         #no search conducted yet, default form
         except ExistDBException as e:
             query_error = True
             if 'Cannot parse' in e.message():
                 messages.error(request, 'Your search query could not be parsed.  ' + 'Please revise your search and try again.')
+            elif too_many_clauses(e):
+                messages.error(request, 'Your search matches too many words.  ' +
+                               'Please use a longer word before the * and try again.')
             else:
                 # generic error message for any other exception
                 messages.error(request, 'There was an error processing your search.')
@@ -144,3 +232,21 @@ def searchbox(request):
         response.status_code = 400 
     
     return response
+
+def stats(request):
+    "Query and cache statistics for this worker process (staff only)."
+    # forbidden rather than a login redirect, since the admin is not routed
+    user = getattr(request, 'user', None)
+    if user is None or not (user.is_active and user.is_staff):
+        raise PermissionDenied
+    context = {
+        'view_stats': query_log.view_stats(),
+        'slow_queries': query_log.slow_queries,
+        'slow_threshold': query_log.slow_threshold,
+        'stylesheets': stylesheets.stats(),
+        'result_sets': result_sets.stats(),
+        'pool': pool_stats(),
+    }
+    if summary_index.enabled:
+        context['summary_index'] = summary_index.memory_report()
+    return render(request, 'stats.html', context)
@@ -0,0 +1,41 @@
+<?xml version="1.0" encoding="utf-8"?>
+<xsl:stylesheet xmlns:xsl="http://www.w3.org/1999/XSL/Transform"
+  version="1.0">
+
+  <!-- Format keyword-in-context summaries for a whole page of search
+       results.  Input is one doc element per result, containing the
+       paragraphs generated by the eXist kwic:summarize function:
+         <results><doc id="..."><p><span class="previous"/>
+           <span class="hi"/><span class="following"/></p></doc></results> -->
+
+  <xsl:output method="xml" omit-xml-declaration="yes"/>
+
+  <xsl:template match="/">
+    <snippets>
+      <xsl:apply-templates select="results/doc[p]"/>
+    </snippets>
+  </xsl:template>
+
+  <xsl:template match="doc">
+    <div class="kwic" id="kwic-{@id}">
+      <xsl:apply-templates select="p"/>
+    </div>
+  </xsl:template>
+
+  <xsl:template match="p">
+    <p class="kwic">
+      <xsl:text>... </xsl:text>
+      <xsl:apply-templates select="span"/>
+      <xsl:text> ...</xsl:text>
+    </p>
+  </xsl:template>
+
+  <xsl:template match="span">
+    <xsl:value-of select="."/>
+  </xsl:template>
+
+  <xsl:template match="span[@class='hi']">
+    <span class="match"><xsl:value-of select="."/></span>
+  </xsl:template>
+
+</xsl:stylesheet>
@@ -6,11 +6,14 @@ from django.contrib import admin
 admin.autodiscover()
 
 from oxex.views import docs, doc_display, doc_xml, overview, searchbox
+from oxex.oai import OxExOAIProvider
 
 urlpatterns = patterns('oxex.views',
   url(r'^$', 'overview', name='overview'),
   url(r'^search/$', 'searchbox', name='search'),
   url(r'^browse/$', 'docs', name='docs'),
+  url(r'^stats/$', 'stats', name='stats'),
+  url(r'^oai/$', OxExOAIProvider.as_view(), name='oai'),
   url(r'^(?P<doc_id>[^/]+)/$', 'doc_display', name="doc_display"),
   url(r'^(?P<doc_id>[^/]+)/view=xml$', 'doc_xml', name="doc_xml"),
   url(r'^(?P<doc_id>[^/]+)/download$', 'doc_down', name="doc_down"),
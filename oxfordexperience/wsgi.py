@@ -8,6 +8,18 @@ os.environ.setdefault("DJANGO_SETTINGS_MODULE", "oxfordexperience.settings")
 from django.core.wsgi import get_wsgi_application
 application = get_wsgi_application()
 
+# collection generations must be shared with the ingest process
+from oxex.cache import check_shared_cache
+check_shared_cache()
+
+# load in-process document indexes once per worker
+from oxex.summary import warm_summary_index
+from oxex.fulltext import warm_fulltext_index
+from oxex.facets import warm_facet_index
+warm_summary_index()
+warm_fulltext_index()
+warm_facet_index()
+
 # Apply WSGI middleware here.
 # from helloworld.wsgi import HelloWorldApplication
 # application = HelloWorldApplication(application)